@@ -0,0 +1,87 @@
+from __future__ import print_function, unicode_literals
+
+from bag_updater import PAYLOAD_MANIFEST_FILENAME_GLOB, TAG_MANIFEST_FILENAME_GLOB, find_manifests
+from datetime import datetime
+import hashlib
+import io
+import json
+import os
+from safe_overwrite import safe_overwrite
+
+STATE_VERSION = 1
+
+
+class BagState(object):
+    """The record of the last successful run on a bag, for incremental re-runs.
+
+    The record is a small JSON file in the bag's parent directory (so that it isn't part of the bag), next to
+    its rename journal. It holds the SHA-256 digests of the bag's tag manifests (or, for a bag without any, of its
+    payload manifests) as the run left them, the digest of the rename rules it was run with, the number of files
+    it renamed and the time it finished. While the manifests and rules are unchanged, so is the bag as far as
+    the run is concerned, which current() checks without walking the payload or reading its manifests.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_bag(cls, bag_path):
+        bag_path = os.path.abspath(bag_path)
+        parent, bag_name = os.path.split(bag_path)
+        return cls(os.path.join(parent, '.%s.rename-state' % bag_name))
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """the recorded state, or None if there's none (or it can't be read)"""
+        try:
+            with io.open(self.path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(state, dict) or state.get('version') != STATE_VERSION:
+            return None
+        return state
+
+    def current(self, bag_path, rules_digest):
+        """the recorded state if the bag's manifests and the rules are as recorded, otherwise None"""
+        state = self.load()
+        if state is None or state.get('rules') != rules_digest:
+            return None
+        if state.get('manifests') != manifest_digests(bag_path):
+            return None
+        return state
+
+    def save(self, bag_path, rules_digest, renamed):
+        """record a successful run on the bag, with the rules' digest and the number of files it renamed"""
+        state = {
+            'version': STATE_VERSION,
+            'bag': os.path.abspath(bag_path),
+            'manifests': manifest_digests(bag_path),
+            'rules': rules_digest,
+            'renamed': renamed,
+            'finished': datetime.now().isoformat(),
+        }
+        with safe_overwrite(self.path, prefix='.', suffix='.tmp') as f:
+            f.write(json.dumps(state, indent=2, sort_keys=True))
+            f.write('\n')
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
+
+
+def manifest_digests(bag_path):
+    """map of the bag's tag manifests (or, if it has none, its payload manifests) to their SHA-256 digests"""
+    manifests = find_manifests(bag_path, TAG_MANIFEST_FILENAME_GLOB) or \
+        find_manifests(bag_path, PAYLOAD_MANIFEST_FILENAME_GLOB)
+    digests = {}
+    for manifest in manifests:
+        sha256 = hashlib.sha256()
+        with io.open(manifest.path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+        digests[manifest.relpath] = sha256.hexdigest()
+    return digests
+
@@ -5,11 +5,20 @@ from __future__ import print_function, unicode_literals
 
 import bagit
 import collections
+import fnmatch
+import glob
 import hashlib
+import io
+import itertools
 import logging
+import multiprocessing
 import os
 import re
-from safe_overwrite import safe_overwrite
+from fixity_cache import stat_key
+from instrumentation import Metrics
+from manifest_rewriter import encode_map, rewrite_manifest
+from safe_overwrite import OverwriteTransaction, recover_overwrites
+from walker import walk_dir
 
 MODULE_NAME = 'bagit_updater' if __name__ == '__main__' else __name__
 
@@ -17,24 +26,320 @@ LOGGER = logging.getLogger(MODULE_NAME)
 
 Manifest = collections.namedtuple('Manifest', ['type', 'algorithm', 'path', 'relpath'])
 MANIFEST_FILENAME_PATTERN = re.compile(r'\A(?P<type>(\S+))-(?P<algorithm>(\S+))\.txt\Z')
-MANIFEST_ENTRY_PATTERN = re.compile(r'\A(?P<hash>(\S+))(?P<spaces>(\s+))(?P<filename>(\S.*))\Z')
+PAYLOAD_MANIFEST_FILENAME_GLOB = 'manifest-*.txt'
+TAG_MANIFEST_FILENAME_GLOB = 'tagmanifest-*.txt'
+# the levels of validation of Bag.validate_level, most thorough first
+VALIDATION_LEVELS = ('full', 'structure', 'oxum', 'none')
+# files are hashed a block of this size at a time, read into one reused buffer
+HASH_BUFFER_SIZE = 1024 * 1024
+# the parts of a payload file's stat that a rename must leave untouched
+PayloadStat = collections.namedtuple('PayloadStat', ['size', 'inode'])
+
+
+class RenameValidationDetail(bagit.ManifestErrorDetail):
+    def __init__(self, path, message):
+        super(RenameValidationDetail, self).__init__(path)
+        self.message = message
+
+    def __str__(self):
+        return '%s: %s' % (self.path, self.message)
+
+
+class ManifestCache(object):
+    """Parsed manifests, each valid while the stat_key()s of the files it was parsed from are unchanged.
+
+    Holds up to max_items parses, dropping the least recently used.
+    """
+
+    def __init__(self, max_items=16):
+        self.max_items = max_items
+        self._items = collections.OrderedDict()
+
+    def get(self, name, key):
+        item = self._items.pop(name, None)
+        if item is None or item[0] != key:
+            return None
+        self._items[name] = item
+        return item[1]
+
+    def put(self, name, key, value):
+        self._items.pop(name, None)
+        self._items[name] = (key, value)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+
+class BagView(object):
+    """A lazy, manifest-only view of a bag.
+
+    Opening a view only reads bagit.txt. The manifests are found by name, as
+    bagit_manifest_updater.get_manifests does, and their entries are only parsed when asked for, through
+    the manifest cache if given one, so that opening and refreshing views of an unchanged bag are close to free.
+    open_bag() opens the full Bag, e.g. to validate it.
+    """
+
+    def __init__(self, path, manifest_cache=None):
+        self.path = os.path.abspath(path)
+        self.manifest_cache = manifest_cache
+        bagit_file = os.path.join(self.path, 'bagit.txt')
+        if not os.path.isfile(bagit_file):
+            raise bagit.BagError('Expected bagit.txt does not exist: %s' % bagit_file)
+        self.tags = bagit._load_tag_file(bagit_file)
+        if 'Tag-File-Character-Encoding' not in self.tags:
+            raise bagit.BagError('Missing required tag in bagit.txt: Tag-File-Character-Encoding')
+        self.encoding = self.tags['Tag-File-Character-Encoding']
+
+    def refresh(self):
+        return self.__class__(self.path, manifest_cache=self.manifest_cache)
+
+    def open_bag(self, fixity_cache=None, metrics=None):
+        return Bag(self.path, fixity_cache=fixity_cache, metrics=metrics, manifest_cache=self.manifest_cache)
+
+    def payload_manifests(self):
+        return find_manifests(self.path)
+
+    def tag_manifests(self):
+        return find_manifests(self.path, TAG_MANIFEST_FILENAME_GLOB)
+
+    @property
+    def algorithms(self):
+        return [manifest.algorithm for manifest in self.payload_manifests()]
+
+    def manifest_entries(self, manifest):
+        """map of filename to hash for the entries of the Manifest (which mustn't be changed)"""
+        return cached_manifest_entries(manifest.path, encoding=self.encoding, cache=self.manifest_cache)
+
+    def payload_entries(self):
+        """map of payload filename to {algorithm: hash}, as bagit.Bag.payload_entries"""
+        entries = {}
+        for manifest in self.payload_manifests():
+            for path, hash in self.manifest_entries(manifest).items():
+                entries.setdefault(path, {})[manifest.algorithm] = hash
+        return entries
+
+    def payload_files(self, executor=None):
+        return payload_files(self.path, executor=executor)
+
+    def validate_oxum(self):
+        """as Bag.validate_level('oxum'), but without opening the bag: check for its data directory and payload
+        manifests, and its Payload-Oxum (if any)
+        """
+        data_dir = os.path.join(self.path, 'data')
+        if not os.path.isdir(data_dir):
+            raise bagit.BagValidationError('Expected data directory %s does not exist' % data_dir)
+        if not self.payload_manifests():
+            raise bagit.BagValidationError('No manifest files found')
+        info_file = os.path.join(self.path, 'bag-info.txt')
+        info = bagit._load_tag_file(info_file, encoding=self.encoding) if os.path.isfile(info_file) else {}
+        validate_oxum(self.path, info.get('Payload-Oxum'))
+        return True
 
 
 class Bag (bagit.Bag):
 
+    def __init__(self, path, fixity_cache=None, metrics=None, manifest_cache=None):
+        # set before opening, since bagit.Bag loads the bag in its constructor
+        self.fixity_cache = fixity_cache
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.manifest_cache = manifest_cache
+        super(Bag, self).__init__(path)
+
     def refresh(self):
-        return self.__class__(self.path)
+        return self.__class__(self.path, fixity_cache=self.fixity_cache, metrics=self.metrics,
+                              manifest_cache=self.manifest_cache)
 
-    def update_payload_filenames(self, rename_map=None, payload_manifests=None, tag_manifests=None):
+    def _load_manifests(self):
+        """as bagit.Bag._load_manifests, but reusing the entries of an earlier load of the same manifests from the
+        manifest cache, if any
+        """
+        if self.manifest_cache is None:
+            return super(Bag, self)._load_manifests()
+        manifests = list(self.manifest_files())
+        if self.version_info >= (0, 97):
+            manifests += list(self.tagmanifest_files())
+        try:
+            key = (self.encoding, tuple((manifest, stat_key(os.stat(manifest))) for manifest in manifests))
+        except OSError:
+            key = None
+        cached = self.manifest_cache.get((self.path, 'bag'), key) if key is not None else None
+        if cached is None:
+            super(Bag, self)._load_manifests()
+            if key is not None:
+                self.manifest_cache.put((self.path, 'bag'), key, (dict(self.entries), list(self.algorithms)))
+            return
+        entries, algorithms = cached
+        # the dict is copied, since a Bag may change its entries, but the (unchanged) hashes of each are shared
+        self.entries = dict(entries)
+        self.algorithms = list(algorithms)
+        self.normalized_manifest_names.update((bagit.normalize_unicode(i), i) for i in self.entries.keys())
+
+    def payload_files(self, executor=None):
+        """as bagit.Bag.payload_files, but enumerated with walker.walk_dir"""
+        for rel_path in payload_files(self.path, executor=executor):
+            self.normalized_filesystem_names[bagit.normalize_unicode(rel_path)] = rel_path
+            yield rel_path
+
+    def validate_level(self, level='full', processes=1):
+        """Validate the bag to one of VALIDATION_LEVELS:
+            full: as validate(), re-calculating the checksums of all files
+            structure: the bag's structure, its Payload-Oxum (if any), that its payload files are exactly those in
+                its payload manifests, and its tag manifests (without reading the payload)
+            oxum: the bag's structure and its Payload-Oxum (if any)
+            none: nothing
+        Raises bagit.BagValidationError (or bagit.BagError) on failure, otherwise returns True.
+        """
+        if level not in VALIDATION_LEVELS:
+            raise ValueError('Unknown validation level: %s' % level)
+        if level == 'full':
+            return self.validate(processes=processes)
+        if level == 'none':
+            return True
+        self._validate_structure()
+        self._validate_bagittxt()
+        self.validate_fetch()
+        if not self.has_oxum():
+            LOGGER.warning('%s has no Payload-Oxum to validate', self)
+        self._validate_oxum()
+        if level == 'structure':
+            self._validate_completeness()
+            errors = tag_manifest_errors(self.path, self.manifest_objects(self.tagmanifest_files()),
+                                         encoding=self.encoding, cache=self.manifest_cache)
+            for e in errors:
+                LOGGER.warning(str(e))
+            if errors:
+                raise bagit.BagValidationError('Bag validation failed', errors)
+        return True
+
+    def _validate_oxum(self):
+        """as bagit.Bag._validate_oxum, but with the payload files' sizes from the walk that finds them"""
+        oxum = self.info.get('Payload-Oxum')
+        if isinstance(oxum, list):
+            LOGGER.warning('bag-info.txt defines multiple Payload-Oxum values!')
+            oxum = oxum[0]
+        validate_oxum(self.path, oxum)
+
+    def _validate_entries(self, processes):
+        """as bagit.Bag._validate_entries, but trusting digests from the fixity cache (if any)
+        for files whose device, inode, size and mtime are unchanged since they were cached, and
+        reporting progress to the metrics
+        """
+        entries = [(rel_path, hashes, [alg for alg in hashes if alg in self.algorithms])
+                   for rel_path, hashes in self.entries.items()]
+        errors = []
+        for rel_path, f_hashes, hashes in self._hash_entries(entries, processes):
+            for alg, computed_hash in f_hashes.items():
+                stored_hash = hashes[alg]
+                if stored_hash.lower() != computed_hash:
+                    e = bagit.ChecksumMismatch(rel_path, alg, stored_hash.lower(), computed_hash)
+                    LOGGER.warning(str(e))
+                    errors.append(e)
+
+        if errors:
+            raise bagit.BagValidationError('Bag validation failed', errors)
+
+    def _hash_entries(self, entries, processes):
+        """the digests of the files of entries, (rel_path, hashes, algorithms), as a list of
+        (rel_path, {algorithm: digest}, hashes): hash_entries() with the bag's fixity cache and metrics
+        """
+        return list(hash_entries(self.path, entries, processes=processes, fixity_cache=self.fixity_cache,
+                                 metrics=self.metrics, filesystem_names=self.normalized_filesystem_names))
+
+    def update_manifest_algorithms(self, payload_algorithms=None, tag_algorithms=None, processes=1):
+        """Add or replace the algorithms of the bag's payload and tag manifests.
+
+        payload_algorithms and tag_algorithms are the algorithms that the bag is to have manifests of (None to
+        keep the current ones): manifests of new algorithms are written, and those of algorithms not listed are
+        removed. Before anything is written, all of the tag files, the payload manifests included, are verified
+        against the tag manifests, and each payload file is read once (in up to processes processes) for its
+        digests by all of the new payload algorithms and all of the current ones, by which it's verified; the
+        fixity cache is used as in validation. The new payload manifests and all of the tag
+        manifests are then written in one safe_overwrite.OverwriteTransaction, and the old manifests removed.
+        The Bag should be refresh()ed afterwards.
+        """
+        # a crash of an earlier update leaves its transaction to recover
+        recover_overwrites(self.path)
+        # (self.algorithms also has the tag manifests' algorithms)
+        current_payload_algorithms = [pmf.algorithm for pmf in self.manifest_objects(self.manifest_files())]
+        current_tag_algorithms = [tmf.algorithm for tmf in self.manifest_objects(self.tagmanifest_files())]
+        payload_algorithms = current_payload_algorithms if payload_algorithms is None else list(payload_algorithms)
+        tag_algorithms = current_tag_algorithms if tag_algorithms is None else list(tag_algorithms)
+        if not payload_algorithms:
+            raise bagit.BagError('A bag must have at least one payload manifest')
+        for alg in payload_algorithms + tag_algorithms:
+            if alg not in bagit.CHECKSUM_ALGOS:
+                raise bagit.BagError('Unsupported checksum algorithm: %s' % alg)
+        new_algorithms = [alg for alg in payload_algorithms if alg not in current_payload_algorithms]
+        payload_manifests = ['manifest-%s.txt' % alg for alg in payload_algorithms]
+
+        # the tag files, the current payload manifests included, verified up front, so that the new tag manifests
+        # only list digests of files that the current ones vouch for
+        errors = []
+        tag_digests = {}
+        for rel_path in tag_files(self.path):
+            hashes = self.entries.get(rel_path, {})
+            f_hashes = file_digests(os.path.join(self.path, rel_path), sorted(set(tag_algorithms) | set(hashes)))
+            errors.extend(bagit.ChecksumMismatch(rel_path, alg, hashes[alg].lower(), f_hashes[alg])
+                          for alg in hashes if hashes[alg].lower() != f_hashes[alg])
+            tag_digests[rel_path] = f_hashes
+
+        new_entries = {}
+        if new_algorithms:
+            entries = [(rel_path, hashes, [alg for alg in hashes if alg in current_payload_algorithms] +
+                        new_algorithms) for rel_path, hashes in self.payload_entries().items()]
+            for rel_path, f_hashes, hashes in self._hash_entries(entries, processes):
+                errors.extend(bagit.ChecksumMismatch(rel_path, alg, hashes[alg].lower(), f_hashes[alg])
+                              for alg in f_hashes if alg in hashes and hashes[alg].lower() != f_hashes[alg])
+                new_entries[rel_path] = f_hashes
+        for e in errors:
+            LOGGER.warning(str(e))
+        if errors:
+            raise bagit.BagValidationError('Bag validation failed', errors)
+
+        with OverwriteTransaction(self.path) as transaction:
+            for manifest in payload_manifests:
+                manifest_file = os.path.join(self.path, manifest)
+                alg = MANIFEST_FILENAME_PATTERN.match(manifest).group('algorithm')
+                if alg in new_algorithms:
+                    manifest_file = transaction.staged_path(manifest_file)
+                    write_manifest(manifest_file, ((rel_path, f_hashes[alg]) for rel_path, f_hashes in
+                                                   new_entries.items()), encoding=self.encoding)
+                    tag_digests[manifest] = file_digests(manifest_file, tag_algorithms)
+            # the payload manifests being removed aren't listed
+            for alg in current_payload_algorithms:
+                if alg not in payload_algorithms:
+                    tag_digests.pop('manifest-%s.txt' % alg, None)
+            for alg in tag_algorithms:
+                write_manifest(transaction.staged_path(os.path.join(self.path, 'tagmanifest-%s.txt' % alg)),
+                               ((rel_path, f_hashes[alg]) for rel_path, f_hashes in tag_digests.items()),
+                               encoding=self.encoding)
+            transaction.commit()
+
+        # only removed once the tag manifests no longer list them
+        for alg in current_payload_algorithms:
+            if alg not in payload_algorithms:
+                os.remove(os.path.join(self.path, 'manifest-%s.txt' % alg))
+        for alg in current_tag_algorithms:
+            if alg not in tag_algorithms:
+                os.remove(os.path.join(self.path, 'tagmanifest-%s.txt' % alg))
+
+    def update_payload_filenames(self, rename_map=None, payload_manifests=None, tag_manifests=None, processes=1,
+                                 rewritten_manifests=(), on_manifest_rewritten=None):
         """OVERALL PROCESS
             given a map of old-to-new filenames (rename_map)
             get list of tagmanifest-*.txt files and associated hash algorithm(s)
-            for each manifest-<algorithm>.txt file
+            for each manifest-<algorithm>.txt file (concurrently, in up to the given number of processes)
                 setup hash update callback for each tagmanifest algorithm
                 rename filepaths from old to new (checksums don't change)
                 snapshot each of the new hash(es) of the manifest
             for each tagmanifest-<algorithm>.txt file
                 update checksums in the given <algorithm> for each of the manifest files previously listed
+            commit the rewritten manifests together (safe_overwrite.OverwriteTransaction)
+            report each rewritten payload manifest's relpath to on_manifest_rewritten, if given
+            payload manifests whose relpath is in rewritten_manifests (e.g. by an interrupted run) aren't
+            rewritten again, only hashed
         """
         bag_dir = self.path
         if rename_map is None or len(rename_map) == 0:
@@ -46,72 +351,410 @@ class Bag (bagit.Bag):
 
         payload_manifest_map = {pmf.algorithm: pmf for pmf in self.manifest_objects(payload_manifests)}
         tag_manifest_map = {tmf.algorithm: tmf for tmf in self.manifest_objects(tag_manifests)}
-        tag_algorithms = tag_manifest_map.keys()
-
-        # for each tagmanifest algorithm, the mapping from each payload manifest to its hash by that algorithm
-        tag_rehash_map = {alg: {} for alg in tag_algorithms}
-
-        # update the file paths in the payload manifests
-        for pmf_alg, pmf in payload_manifest_map.items():
-            # setup the hash accumulaters and the associated updater callbacks
-            hashes = [hashlib.new(tmf_alg) for tmf_alg in tag_algorithms]
-            hash_updaters = [h.update for h in hashes]
-            # update the manifest file with the new filenames
-            update_payload_manifest_filepaths(pmf.path, new_filenames=rename_map,
-                                              write_callbacks=hash_updaters)
-            for h in hashes:
-                tag_rehash_map[h.name].update({pmf.relpath: h.hexdigest()})
+        tag_algorithms = list(tag_manifest_map.keys())
+
+        # encoded once, for all of the payload manifests
+        new_filenames = encode_map(rename_map, self.encoding)
+
+        # the new hash(es) of each payload manifest, by path
+        pmf_hashes = {}
+        pmfs = []
+        for pmf in payload_manifest_map.values():
+            if pmf.relpath in rewritten_manifests:
+                pmf_hashes[pmf.path] = {tmf_alg: file_digest(pmf.path, tmf_alg) for tmf_alg in tag_algorithms}
+            else:
+                pmfs.append(pmf)
+
+        # update the file paths in the payload manifests, collecting the new hash(es) of each, and the hashes in
+        # the tag manifests, as one transaction, so that a crash can't leave a mix of old and new manifests.
+        # rewriting is mostly Python line splitting, which holds the GIL, so use processes rather than threads
+        with OverwriteTransaction(bag_dir) as transaction:
+            args = [(pmf.path, transaction.staged_path(pmf.path)) for pmf in pmfs]
+            pool = None
+            if processes > 1 and len(pmfs) > 1:
+                # the (possibly large) map is handed to the workers once, when they start
+                pool = multiprocessing.Pool(min(processes, len(pmfs)), initializer=_init_payload_manifest_worker,
+                                            initargs=(new_filenames, tag_algorithms, self.encoding))
+                updated = pool.imap_unordered(_update_payload_manifest_worker, args)
+            else:
+                updated = (_update_payload_manifest(path, output_file, new_filenames, tag_algorithms, self.encoding)
+                           for path, output_file in args)
+            progress = self.metrics.progress('manifests_rewritten', total=len(pmfs))
+            try:
+                for path, hashes, lines_rewritten in updated:
+                    pmf_hashes[path] = hashes
+                    self.metrics.count('manifest_lines_rewritten', lines_rewritten)
+                    progress.update()
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+
+            # for each tagmanifest algorithm, the mapping from each payload manifest to its hash by that algorithm
+            tag_rehash_map = {alg: {} for alg in tag_algorithms}
+            for pmf in payload_manifest_map.values():
+                for tmf_alg in tag_algorithms:
+                    tag_rehash_map[tmf_alg].update({pmf.relpath: pmf_hashes[pmf.path][tmf_alg]})
+
+            # update the payload manifest hashes in the tag manifests
+            for tmf_alg, tmf in tag_manifest_map.items():
+                update_tag_manifest_hashes(tmf.path, new_hashes=tag_rehash_map[tmf_alg], encoding=self.encoding,
+                                           output_file=transaction.staged_path(tmf.path))
+            transaction.commit()
 
-        # update the payload manifest hashes in the tag manifests
-        for tmf_alg, tmf in tag_manifest_map.items():
-            update_tag_manifest_hashes(tmf.path, new_hashes=tag_rehash_map[tmf_alg])
+        if on_manifest_rewritten is not None:
+            for pmf in pmfs:
+                on_manifest_rewritten(pmf.relpath)
+
+    def payload_file_stats(self, payload_files=None):
+        """snapshot the size and inode of payload files (relative to the bag) ahead of a rename"""
+        if payload_files is None:
+            payload_files = self.payload_files()
+        stats = {}
+        for payload_file in payload_files:
+            st = os.lstat(os.path.join(self.path, payload_file))
+            stats[payload_file] = PayloadStat(size=st.st_size, inode=st.st_ino)
+        return stats
+
+    def validate_renamed(self, rename_map, payload_stats):
+        """Verify a completed rename without re-hashing the payload.
+
+        Must be called on the Bag as it was opened *before* the rename, since the manifest entries
+        that it loaded are the reference for what the rewritten manifests should now contain.
+        payload_stats is the snapshot taken by payload_file_stats() before the rename.
+        Raises bagit.BagValidationError on failure, otherwise returns True.
+        """
+        errors = []
+
+        # the payload files were moved, not changed
+        for old, new in rename_map.items():
+            if old == new:
+                continue
+            if os.path.lexists(os.path.join(self.path, old)):
+                errors.append(RenameValidationDetail(old, 'old path still exists'))
+            try:
+                st = os.lstat(os.path.join(self.path, new))
+            except OSError:
+                errors.append(bagit.FileMissing(new))
+                continue
+            expected = payload_stats.get(old)
+            if expected is not None and (st.st_size, st.st_ino) != (expected.size, expected.inode):
+                errors.append(RenameValidationDetail(new, 'size/inode %d/%d does not match %d/%d of %s'
+                                                     % (st.st_size, st.st_ino, expected.size, expected.inode, old)))
+
+        # the payload manifests list exactly the renamed entries, with unchanged hashes
+        payload_entries = self.payload_entries()
+        for manifest in self.manifest_objects(self.manifest_files()):
+            expected = {rename_map.get(path, path): hashes[manifest.algorithm]
+                        for path, hashes in payload_entries.items() if manifest.algorithm in hashes}
+            found = cached_manifest_entries(manifest.path, encoding=self.encoding, cache=self.manifest_cache)
+            for path in set(expected) | set(found):
+                if path not in found:
+                    errors.append(RenameValidationDetail(path, 'missing from %s' % manifest.relpath))
+                elif path not in expected:
+                    errors.append(RenameValidationDetail(path, 'unexpected in %s' % manifest.relpath))
+                elif found[path].lower() != expected[path].lower():
+                    errors.append(bagit.ChecksumMismatch(path, manifest.algorithm, expected[path], found[path]))
+
+        # the tag manifests match the rewritten tag files
+        errors.extend(tag_manifest_errors(self.path, self.manifest_objects(self.tagmanifest_files()),
+                                          encoding=self.encoding, cache=self.manifest_cache))
+
+        for e in errors:
+            LOGGER.warning(str(e))
+        if errors:
+            raise bagit.BagValidationError('Bag rename validation failed', errors)
+        return True
 
     def manifest_objects(self, manifest_files, pattern=None):
-        if pattern is None:
-            pattern = MANIFEST_FILENAME_PATTERN
-        for mfile in manifest_files:
-            yield Manifest(path=os.path.abspath(mfile), relpath=os.path.relpath(mfile, start=self.path),
-                        **dict(pattern.match(os.path.basename(mfile)).groupdict()))
+        return manifest_objects(self.path, manifest_files, pattern=pattern)
 
 
-def update_payload_manifest_filepaths(manifest_file, new_filenames=None, line_pattern=None, write_callbacks=None):
-    if new_filenames is None or len(new_filenames) == 0:
-        return
-    if line_pattern is None:
-        line_pattern = MANIFEST_ENTRY_PATTERN
-    with open(manifest_file, 'r') as manifest, safe_overwrite(manifest_file, text=True) as new_manifest:
-        for line in manifest:
-            match = line_pattern.match(line.rstrip("\n"))
-            if match is None:
-                output_line = line
-            else:
-                matched = match.groupdict()
-                filename = matched['filename']
-                matched['filename'] = new_filenames.get(filename, filename)
-                output_line = "%(hash)s%(spaces)s%(filename)s\n" % matched
-            if write_callbacks is not None:
-                for callback in write_callbacks:
-                    callback(output_line)
-            new_manifest.write(output_line)
-
-
-def update_tag_manifest_hashes(manifest_file, new_hashes=None, line_pattern=None, write_callbacks=None):
-    if new_hashes is None or len(new_hashes) == 0:
+def manifest_objects(bag_path, manifest_files, pattern=None):
+    if pattern is None:
+        pattern = MANIFEST_FILENAME_PATTERN
+    for mfile in manifest_files:
+        yield Manifest(path=os.path.abspath(mfile), relpath=os.path.relpath(mfile, start=bag_path),
+                       **dict(pattern.match(os.path.basename(mfile)).groupdict()))
+
+
+def find_manifests(bag_path, fileglob=PAYLOAD_MANIFEST_FILENAME_GLOB):
+    """the Manifests of the bag matching fileglob (by default the payload manifests), without opening the bag"""
+    return list(manifest_objects(bag_path, sorted(glob.glob(os.path.join(bag_path, fileglob)))))
+
+
+def payload_files(bag_path, executor=None):
+    """the bag's payload files, relative to the bag, in the order they're walked (with the directories listed
+    ahead by the fs_executor.FsExecutor, if any)
+    """
+    bag_path = os.path.abspath(bag_path)
+    # the walker's paths are absolute, as is bag_path, so the relative path is a slice
+    prefix_length = len(bag_path) + len(os.sep)
+    for item in walk_dir(os.path.join(bag_path, 'data'), executor=executor):
+        if item.type == 'file':
+            yield item.path[prefix_length:]
+
+
+def validate_oxum(bag_path, oxum):
+    """check the bag's payload against its Payload-Oxum (if not None), as bagit.Bag._validate_oxum does, but
+    with the payload files' sizes from the walk that finds them
+    """
+    if oxum is None:
         return
-    if line_pattern is None:
-        line_pattern = MANIFEST_ENTRY_PATTERN
-    with open(manifest_file, 'r') as manifest, safe_overwrite(manifest_file, text=True) as new_manifest:
+    oxum_byte_count, _, oxum_file_count = oxum.partition('.')
+    if not oxum_byte_count.isdigit() or not oxum_file_count.isdigit():
+        raise bagit.BagError('Malformed Payload-Oxum value: %s' % oxum)
+    total_bytes = total_files = 0
+    stat_errors = []
+    for item in walk_dir(os.path.join(bag_path, 'data'), stat=True, onerror=stat_errors.append):
+        if item.type == 'file' and item.size is not None:
+            total_bytes += item.size
+            total_files += 1
+    if stat_errors:
+        raise bagit.BagValidationError('Payload-Oxum validation failed. Unable to read the sizes of %d payload '
+                                       'files, first %s' % (len(stat_errors), stat_errors[0]))
+    if (int(oxum_file_count), int(oxum_byte_count)) != (total_files, total_bytes):
+        raise bagit.BagValidationError('Payload-Oxum validation failed. Expected %s files and %s bytes but found '
+                                       '%d files and %d bytes' % (oxum_file_count, oxum_byte_count, total_files,
+                                                                  total_bytes))
+
+
+def tag_manifest_errors(bag_path, tag_manifests, encoding='utf-8', cache=None):
+    """the bagit.FileMissing and bagit.ChecksumMismatch errors of the entries of the tag Manifests, each tag file
+    being read once for all of their algorithms
+    """
+    entries = collections.OrderedDict()
+    for manifest in tag_manifests:
+        for path, hash in sorted(cached_manifest_entries(manifest.path, encoding=encoding, cache=cache).items()):
+            entries.setdefault(path, {})[manifest.algorithm] = hash
+    errors = []
+    for path, hashes in entries.items():
+        try:
+            found_hashes = file_digests(os.path.join(bag_path, path), list(hashes))
+        except (OSError, IOError):
+            errors.append(bagit.FileMissing(path))
+            continue
+        errors.extend(bagit.ChecksumMismatch(path, alg, hash, found_hashes[alg])
+                      for alg, hash in hashes.items() if found_hashes[alg] != hash.lower())
+    return errors
+
+
+def tag_files(bag_path):
+    """the bag's tag files, other than its tag manifests, relative to the bag"""
+    bag_path = os.path.abspath(bag_path)
+    prefix_length = len(bag_path) + len(os.sep)
+    for name in sorted(os.listdir(bag_path)):
+        path = os.path.join(bag_path, name)
+        if name == 'data':
+            continue
+        if os.path.isdir(path):
+            for item in walk_dir(path, sort=True):
+                if item.type == 'file':
+                    yield item.path[prefix_length:]
+        elif not fnmatch.fnmatch(name, TAG_MANIFEST_FILENAME_GLOB):
+            yield name
+
+
+def write_manifest(manifest_file, entries, encoding='utf-8'):
+    """write a manifest of entries, (filename relative to the bag, digest), in order of filename"""
+    with open(manifest_file, 'wb') as f:
+        for rel_path, digest in sorted(entries):
+            line = '%s  %s\n' % (digest, bagit._encode_filename(rel_path.replace(os.sep, '/')))
+            f.write(line.encode(encoding))
+
+
+def cached_manifest_entries(manifest_file, encoding='utf-8', cache=None):
+    """read_manifest_entries() through the manifest cache, if any: the result may be shared, so mustn't be changed"""
+    if cache is None:
+        return read_manifest_entries(manifest_file, encoding=encoding)
+    manifest_file = os.path.abspath(manifest_file)
+    key = (encoding, stat_key(os.stat(manifest_file)))
+    entries = cache.get(manifest_file, key)
+    if entries is None:
+        entries = read_manifest_entries(manifest_file, encoding=encoding)
+        cache.put(manifest_file, key, entries)
+    return entries
+
+
+def read_manifest_entries(manifest_file, encoding='utf-8'):
+    """map of filename to hash for the entries of a manifest file, normalized as bagit does"""
+    entries = {}
+    with io.open(manifest_file, 'r', encoding=encoding) as manifest:
         for line in manifest:
-            match = line_pattern.match(line.rstrip("\n"))
-            if match is None:
-                output_line = line
+            line = line.strip().lstrip('\ufeff')
+            if line == '' or line.startswith('#'):
+                continue
+            entry = line.split(None, 1)
+            if len(entry) != 2:
+                continue
+            entries[bagit._decode_filename(os.path.normpath(entry[1].lstrip('*')))] = entry[0]
+    return entries
+
+
+def hash_entries(bag_path, entries, processes=1, fixity_cache=None, metrics=None, filesystem_names=None,
+                 window=None):
+    """yield (rel_path, {algorithm: digest}, hashes) for each of entries, (rel_path, hashes, algorithms), its
+    file's digests by its algorithms, each file read once, in up to processes processes.
+
+    Digests are taken from the fixity cache (if any) instead for files whose device, inode, size and mtime
+    are unchanged since they were cached, if it has them all and they match the file's hashes; the digests
+    read are put in it. Unreadable files get the error message as their digests. filesystem_names maps the
+    rel_paths of files named differently in the filesystem (e.g. by Unicode normalization). With a window,
+    entries (which may be an iterator) are hashed window at a time, so that they aren't all read ahead.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    if filesystem_names is None:
+        filesystem_names = {}
+    entries = iter(entries)
+    progress = None
+    pool = None
+    try:
+        while True:
+            args = []
+            read = 0
+            for rel_path, hashes, algorithms in (itertools.islice(entries, window) if window else entries):
+                read += 1
+                fs_path = filesystem_names.get(rel_path, rel_path)
+                if fixity_cache is not None:
+                    try:
+                        st = os.stat(os.path.join(bag_path, fs_path))
+                    except OSError:
+                        pass  # leave it to the hashing to report
+                    else:
+                        cached = fixity_cache.get(stat_key(st), algorithms)
+                        if all(alg in cached and cached[alg] == hashes.get(alg, cached[alg]).lower()
+                               for alg in algorithms):
+                            metrics.count('files_cached')
+                            yield rel_path, {alg: cached[alg] for alg in algorithms}, hashes
+                            continue
+                args.append((bag_path, rel_path, fs_path, hashes, algorithms))
+            if not read:
+                break
+            if fixity_cache is not None:
+                # release any write lock taken by evictions before the (long) hashing
+                fixity_cache.commit()
+            if progress is None:
+                progress = metrics.progress('files_hashed', total=len(args) if not window else None)
+            if processes == 1:
+                results = (_calc_file_hashes(i) for i in args)
             else:
-                matched = match.groupdict()
-                hash = matched['hash']
-                filename = matched['filename']
-                matched['hash'] = new_hashes.get(filename, hash)
-                output_line = "%(hash)s%(spaces)s%(filename)s\n" % matched
-            if write_callbacks is not None:
-                for callback in write_callbacks:
-                    callback(output_line)
-            new_manifest.write(output_line)
+                if pool is None:
+                    worker_init = bagit.posix_multiprocessing_worker_initializer if os.name == 'posix' else None
+                    pool = multiprocessing.Pool(processes if processes else None, initializer=worker_init)
+                # imap rather than map, to see the results (and progress) as they come
+                results = pool.imap(_calc_file_hashes, args, chunksize=16)
+            hash_results = []
+            for result in results:
+                hash_results.append(result)
+                key = result[1]
+                if key is not None:
+                    metrics.count('bytes_hashed', key[2])
+                progress.update()
+            for rel_path, key, f_hashes, hashes in hash_results:
+                if key is not None and fixity_cache is not None:
+                    fixity_cache.put(key, f_hashes)
+            if fixity_cache is not None:
+                fixity_cache.commit()
+            for rel_path, key, f_hashes, hashes in hash_results:
+                yield rel_path, f_hashes, hashes
+            if not window:
+                break
+        if pool is not None:
+            pool.close()
+            pool.join()
+    except BaseException as e:
+        # (including the generator being closed early, which isn't an error)
+        if not isinstance(e, GeneratorExit):
+            LOGGER.exception('Unable to calculate file hashes for %s', bag_path)
+        if pool is not None:
+            pool.terminate()
+        raise
+
+
+def _calc_file_hashes(args):
+    """multiprocessing worker: (rel_path, stat_key or None, {algorithm: digest}, hashes)
+
+    The stat_key is None, meaning that the digests must not be cached, if the file could not be read
+    or changed while it was being read. Unreadable files get the error message as their digest.
+    """
+    base_path, rel_path, fs_path, hashes, algorithms = args
+    full_path = os.path.join(base_path, fs_path)
+    f_hashers = {alg: hashlib.new(alg) for alg in algorithms}
+    try:
+        key = stat_key(os.stat(full_path))
+        _hash_file(full_path, list(f_hashers.values()))
+        if stat_key(os.stat(full_path)) != key:
+            key = None
+    except (OSError, IOError) as e:
+        message = 'Could not read %s: %s' % (full_path, e)
+        return rel_path, None, {alg: message for alg in f_hashers}, hashes
+    return rel_path, key, {alg: h.hexdigest() for alg, h in f_hashers.items()}, hashes
+
+
+def file_digest(path, algorithm):
+    return file_digests(path, [algorithm])[algorithm]
+
+
+def file_digests(path, algorithms):
+    """map of algorithm to the file's digest by it, reading the file once"""
+    hashes = [hashlib.new(alg) for alg in algorithms]
+    _hash_file(path, hashes)
+    # key by the requested algorithm, since hashlib may report e.g. 'MD5' as the hash name
+    return {alg: h.hexdigest() for alg, h in zip(algorithms, hashes)}
+
+
+def _hash_file(path, hashes):
+    """update each of the hashes with the contents of the file, read once, into a single buffer"""
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with io.open(path, 'rb', buffering=0) as f:
+        while True:
+            length = f.readinto(buf)
+            if not length:
+                break
+            block = view[:length]
+            for h in hashes:
+                h.update(block)
+
+
+def _update_payload_manifest(manifest_file, output_file, new_filenames, tag_algorithms, encoding):
+    """rename the filepaths in a payload manifest, writing it to output_file, returning the manifest_file, the new
+    hash of the manifest by each tag algorithm and the number of lines rewritten
+    """
+    hashes = [hashlib.new(tmf_alg) for tmf_alg in tag_algorithms]
+    lines_rewritten = update_payload_manifest_filepaths(manifest_file, new_filenames=new_filenames,
+                                                        write_callbacks=[h.update for h in hashes], encoding=encoding,
+                                                        output_file=output_file)
+    # key by the requested algorithm, since hashlib may report e.g. 'MD5' as the hash name
+    return manifest_file, {tmf_alg: h.hexdigest() for tmf_alg, h in zip(tag_algorithms, hashes)}, lines_rewritten
+
+
+_payload_manifest_worker_args = ()
+
+
+def _init_payload_manifest_worker(new_filenames, tag_algorithms, encoding):
+    global _payload_manifest_worker_args
+    _payload_manifest_worker_args = (new_filenames, tag_algorithms, encoding)
+
+
+def _update_payload_manifest_worker(args):
+    manifest_file, output_file = args
+    return _update_payload_manifest(manifest_file, output_file, *_payload_manifest_worker_args)
+
+
+# with an output_file (which must be written), the manifest is rewritten to it even if there are no changes
+def update_payload_manifest_filepaths(manifest_file, new_filenames=None, write_callbacks=None, encoding='utf-8',
+                                      output_file=None):
+    if (new_filenames is None or len(new_filenames) == 0) and output_file is None:
+        return 0
+    return rewrite_manifest(manifest_file, new_filenames=new_filenames, write_callbacks=write_callbacks, encoding=encoding,
+                            output_file=output_file)
+
+
+def update_tag_manifest_hashes(manifest_file, new_hashes=None, write_callbacks=None, encoding='utf-8',
+                               output_file=None):
+    if (new_hashes is None or len(new_hashes) == 0) and output_file is None:
+        return 0
+    return rewrite_manifest(manifest_file, new_hashes=new_hashes, write_callbacks=write_callbacks, encoding=encoding,
+                            output_file=output_file)
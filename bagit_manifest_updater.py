@@ -4,12 +4,11 @@ import collections
 import glob
 import hashlib
 import os
+from manifest_rewriter import rewrite_manifest
 import re
-from safe_overwrite import safe_overwrite
 import tempfile
 from walker import walk_dir
 
-MANIFEST_LINE_PATTERN = re.compile(r'\A(?P<hash>(\S+))(?P<spaces>(\s+))(?P<filename>(\S.*))\Z')
 # attributes of Manifest named tuple must include at least all match named groups in MANIFEST_FILENAME_PATTERN
 # PAYLOAD_MANIFEST_FILENAME_GLOB and TAG_MANIFEST_FILENAME_GLOB must match MANIFEST_FILENAME_PATTERN
 PAYLOAD_MANIFEST_FILENAME_GLOB = 'manifest-*.txt'
@@ -45,7 +44,7 @@ def main():
 def manifest_updater(bag, rename_map=None):
     payload_manifests = {pmf.algorithm: pmf for pmf in get_payload_manifests(bag)}
     tag_manifests = {tmf.algorithm: tmf for tmf in get_tag_manifests(bag)}
-    tag_algorithms = tag_manifests.keys()
+    tag_algorithms = list(tag_manifests.keys())
     # will hold for each tagmanifest algorithm, the mapping from each payload manifest to its hash by that algorithm
     tag_rehash_map = {alg: {} for alg in tag_algorithms}
     for pmf_alg, pmf in payload_manifests.items():
@@ -54,7 +53,7 @@ def manifest_updater(bag, rename_map=None):
         hash_updaters = [h.update for h in hashes]
         # update the manifest file with the new filenames
         update_payload_manifest_filepaths(bag, pmf.filename, new_filenames=rename_map, write_callbacks=hash_updaters)
-        [tag_rehash_map[h.name].update({pmf.filename: h.hexdigest()}) for h in hashes]
+        [tag_rehash_map[tmf_alg].update({pmf.filename: h.hexdigest()}) for tmf_alg, h in zip(tag_algorithms, hashes)]
     for tmf_alg, tmf in tag_manifests.items():
         update_tag_manifest_hashes(bag, tmf.filename, new_hashes=tag_rehash_map[tmf_alg])
 
@@ -77,51 +76,18 @@ def get_tag_manifests(bag, fileglob=TAG_MANIFEST_FILENAME_GLOB, pattern=MANIFEST
 
 
 
-# todo: need a mechanism to build the hashes, as the manifest is updated.
-# todo: that means that we need to know which tagmanifest algorithms are in use.
-def update_payload_manifest_filepaths(bag, manifest_file, new_filenames=None, line_pattern=None, write_callbacks=None):
+def update_payload_manifest_filepaths(bag, manifest_file, new_filenames=None, write_callbacks=None, encoding='utf-8'):
     if new_filenames is None or len(new_filenames) == 0:
         return
-    if line_pattern is None:
-        line_pattern = MANIFEST_LINE_PATTERN
-    manifest_file = os.path.join(bag, manifest_file)
-    with open(manifest_file, 'r') as manifest, safe_overwrite(manifest_file, text=True) as new_manifest:
-        for line in manifest:
-            match = line_pattern.match(line.rstrip("\n"))
-            if match is None:
-                output_line = line
-            else:
-                matched = match.groupdict()
-                filename = matched['filename']
-                matched['filename'] = new_filenames.get(filename, filename)
-                output_line = "%(hash)s%(spaces)s%(filename)s\n" % matched
-            if write_callbacks is not None:
-                for callback in write_callbacks:
-                    callback(output_line)
-            new_manifest.write(output_line)
-
-
-def update_tag_manifest_hashes(bag, manifest_file, new_hashes=None, line_pattern=None, write_callbacks=None):
+    rewrite_manifest(os.path.join(bag, manifest_file), new_filenames=new_filenames, write_callbacks=write_callbacks,
+                     encoding=encoding)
+
+
+def update_tag_manifest_hashes(bag, manifest_file, new_hashes=None, write_callbacks=None, encoding='utf-8'):
     if new_hashes is None or len(new_hashes) == 0:
         return
-    if line_pattern is None:
-        line_pattern = MANIFEST_LINE_PATTERN
-    manifest_file = os.path.join(bag, manifest_file)
-    with open(manifest_file, 'r') as manifest, safe_overwrite(manifest_file, text=True) as new_manifest:
-        for line in manifest:
-            match = line_pattern.match(line.rstrip("\n"))
-            if match is None:
-                output_line = line
-            else:
-                matched = match.groupdict()
-                hash = matched['hash']
-                filename = matched['filename']
-                matched['hash'] = new_hashes.get(filename, hash)
-                output_line = "%(hash)s%(spaces)s%(filename)s\n" % matched
-            if write_callbacks is not None:
-                for callback in write_callbacks:
-                    callback(output_line)
-            new_manifest.write(output_line)
+    rewrite_manifest(os.path.join(bag, manifest_file), new_hashes=new_hashes, write_callbacks=write_callbacks,
+                     encoding=encoding)
 
 if __name__=='__main__':
     main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import hashlib
+import io
+from manifest_rewriter import encode_map, rewrite_manifest
+import os
+import re
+from safe_overwrite import safe_overwrite
+import shutil
+import tempfile
+import time
+
+# the per-line implementation that manifest_rewriter replaced, kept here as the baseline
+LEGACY_ENTRY_PATTERN = re.compile(r'\A(?P<hash>(\S+))(?P<spaces>(\s+))(?P<filename>(\S.*))\Z')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the legacy per-line manifest rewriter with '
+                                                 'manifest_rewriter.rewrite_manifest')
+    parser.add_argument('--lines', type=int, default=1000000, help='manifest entries (default: %(default)s)')
+    parser.add_argument('--renamed', type=float, default=1.0,
+                        help='fraction of the entries to rename (default: %(default)s)')
+    parser.add_argument('--tag-algorithms', default='md5,sha256',
+                        help='algorithms hashing the output, as for the tag manifests (default: %(default)s)')
+    args = parser.parse_args()
+    tag_algorithms = args.tag_algorithms.split(',')
+
+    work_dir = tempfile.mkdtemp(prefix='bench_manifest_rewriter-')
+    try:
+        manifest = os.path.join(work_dir, 'manifest-sha256.txt')
+        rename_map = make_manifest(manifest, args.lines, args.renamed)
+        print('%d manifest lines, %d renamed, output hashed with %s'
+              % (args.lines, len(rename_map), ', '.join(tag_algorithms)))
+
+        # as in Bag.update_payload_filenames, the map is encoded once for all the payload manifests
+        start = time.time()
+        encoded_rename_map = encode_map(rename_map)
+        print('%-32s %8.2fs' % ('encode_map', time.time() - start))
+
+        results = {}
+        for name, rewriter, new_filenames in (('legacy', legacy_rewrite, rename_map),
+                                              ('rewrite_manifest', rewrite_manifest, rename_map),
+                                              ('rewrite_manifest (encoded map)', rewrite_manifest, encoded_rename_map)):
+            copy = os.path.join(work_dir, 'output.txt')
+            shutil.copyfile(manifest, copy)
+            hashes = [hashlib.new(alg) for alg in tag_algorithms]
+            start = time.time()
+            rewriter(copy, new_filenames=new_filenames, write_callbacks=[h.update for h in hashes])
+            elapsed = time.time() - start
+            with open(copy, 'rb') as f:
+                results[name] = (f.read(), [h.hexdigest() for h in hashes])
+            print('%-32s %8.2fs %12.0f lines/s' % (name, elapsed, args.lines / elapsed))
+
+        for name, result in results.items():
+            if result != results['legacy']:
+                raise SystemExit('ERROR: %s output or hashes differ from the legacy rewriter' % name)
+        print('outputs and hashes are identical')
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def make_manifest(path, lines, renamed):
+    """write a sha256 manifest of the given number of entries, led by a few irregular lines, and return a
+    rename map for the given fraction of them
+    """
+    rename_map = {}
+    rename_every = int(round(1 / renamed)) if renamed > 0 else 0
+    with io.open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write('# comment\n\n  indented  data/indented.tif\n%s\tdata/tab separated.tif\n' % ('0' * 64))
+        for i in range(lines):
+            filename = 'data/box%03d/folder%04d/image%07d.tif' % (i // 100000, i // 1000, i)
+            f.write('%064x  %s\n' % (i, filename))
+            if rename_every and i % rename_every == 0:
+                rename_map[filename] = filename.replace('image', 'jhu_coll-01_image')
+        # no newline after the last entry
+        f.write('%064x  data/last.tif' % lines)
+    rename_map['data/tab separated.tif'] = 'data/tab_separated.tif'
+    rename_map['data/last.tif'] = 'data/jhu_last.tif'
+    return rename_map
+
+
+def legacy_rewrite(manifest_file, new_filenames=None, write_callbacks=None):
+    with io.open(manifest_file, 'r', encoding='utf-8', newline='') as manifest, \
+            safe_overwrite(manifest_file, text=False) as new_manifest:
+        for line in manifest:
+            match = LEGACY_ENTRY_PATTERN.match(line.rstrip("\n"))
+            if match is None:
+                output_line = line
+            else:
+                matched = match.groupdict()
+                filename = matched['filename']
+                matched['filename'] = new_filenames.get(filename, filename)
+                output_line = "%(hash)s%(spaces)s%(filename)s\n" % matched
+            # encoded here, since hashlib only takes bytes
+            output_line = output_line.encode('utf-8')
+            for callback in write_callbacks:
+                callback(output_line)
+            new_manifest.write(output_line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+from bag_updater import VALIDATION_LEVELS, Bag
+from bulk_rename import BulkRenamer
+import collections
+import contextlib
+from datetime import date
+from fs_executor import FsExecutor
+import hashlib
+from instrumentation import Metrics
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+from rename_bag_payload import load_rules, rename_files, rename_journalled
+from rename_journal import DEFAULT_BATCH_SIZE, RenameJournal
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from walker import walk_dir
+try:
+    import resource
+except ImportError:
+    resource = None  # e.g. Windows: no peak RSS
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+MB = 1024 * 1024
+
+SyntheticBag = collections.namedtuple('SyntheticBag', ['path', 'files', 'bytes', 'manifest_lines'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic bag and time each phase of renaming its '
+                                                 'payload and updating its manifests, as rename_bag_payload does')
+    parser.add_argument('--files', type=int, default=10000, help='payload files (default: %(default)s)')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='directory levels below data/ (default: %(default)s)')
+    parser.add_argument('--fanout', type=int, default=10,
+                        help='subdirectories of each directory (default: %(default)s)')
+    parser.add_argument('--size-distribution', dest='size_distribution', choices=['fixed', 'uniform', 'lognormal'],
+                        default='lognormal', help='distribution of the file sizes (default: %(default)s)')
+    parser.add_argument('--size', type=int, default=4096, help='mean file size in bytes (default: %(default)s)')
+    parser.add_argument('--max-size', dest='max_size', type=int, default=64 * MB,
+                        help='largest file size in bytes (default: %(default)s)')
+    parser.add_argument('--algorithms', default='md5,sha256',
+                        help='payload manifest algorithms (default: %(default)s)')
+    parser.add_argument('--tag-algorithms', dest='tag_algorithms', default='md5,sha256',
+                        help='tag manifest algorithms (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the file sizes (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='processes calculating checksums in validation (default: %(default)s)')
+    parser.add_argument('--manifest-processes', dest='manifest_processes', type=int, default=1,
+                        help='processes rewriting the payload manifests (default: %(default)s)')
+    parser.add_argument('--pre-validate', dest='pre_validate', choices=VALIDATION_LEVELS, default='full',
+                        help='pre-update validation, as in rename_bag_payload (default: %(default)s)')
+    parser.add_argument('--post-validate', dest='post_validate', choices=['full', 'rename'], default='full',
+                        help='post-update validation, as in rename_bag_payload (default: %(default)s)')
+    parser.add_argument('--journal-batch-size', dest='journal_batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='renames journalled at a time (default: %(default)s)')
+    parser.add_argument('--fs-threads', dest='fs_threads', type=int, default=1,
+                        help='filesystem calls in flight at once in the plan, rename and walk phases, as in '
+                             'rename_bag_payload (default: %(default)s)')
+    parser.add_argument('--rules', help='JSON file of rename rules, as for rename_bag_payload (default: the JHU rules)')
+    parser.add_argument('--confirm-python', dest='confirm_python',
+                        help='Python 2 interpreter with which to also time confirmFileNameChanges.py (which is '
+                             'Python 2 only); skipped if not given')
+    parser.add_argument('--work-dir', dest='work_dir',
+                        help='directory in which to generate the bag, e.g. on the volume to be measured '
+                             '(default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help="don't remove the generated bag")
+    parser.add_argument('--json', dest='json_file', help='file to receive the results as JSON')
+    parser.add_argument('--baseline', help='JSON results of an earlier run, to compare the phase times with')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_rename_pipeline-', dir=args.work_dir)
+    try:
+        results = run(args, work_dir)
+    finally:
+        if args.keep:
+            print("Kept '%s'" % work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+    print_results(results)
+    if args.baseline is not None:
+        with io.open(args.baseline, encoding='utf-8') as f:
+            print_comparison(results, json.load(f))
+    if args.json_file is not None:
+        with io.open(args.json_file, 'w', encoding='utf-8') as f:
+            # io text files only take unicode, which json.dumps doesn't always return under Python 2
+            f.write('%s\n' % json.dumps(results, indent=2, sort_keys=True))
+
+
+def run(args, work_dir):
+    """generate the bag in work_dir and time each phase of updating it, returning the results as a dict"""
+    algorithms = args.algorithms.split(',')
+    tag_algorithms = args.tag_algorithms.split(',')
+    # rename_files takes the collection from the first two '-'-separated fields of the bag's name
+    bag_path = os.path.join(work_dir, 'bench-01-bag')
+    phases = collections.OrderedDict()
+    timer = PhaseTimer(phases)
+
+    with timer('generate') as phase:
+        bag = make_bag(bag_path, args.files, depth=args.depth, fanout=args.fanout,
+                       sizes=file_sizes(args.size_distribution, args.size, args.max_size, args.seed),
+                       algorithms=algorithms, tag_algorithms=tag_algorithms)
+        phase.update(files=bag.files, bytes=bag.bytes)
+    print('Generated %d files, %.1f MB, in %d payload manifests'
+          % (bag.files, bag.bytes / MB, len(algorithms)), file=sys.stderr)
+
+    with timer('open') as phase:
+        updater = Bag(bag.path)
+        phase.update(lines=bag.manifest_lines)
+
+    renamer = BulkRenamer(updater.path)
+    with timer('plan') as phase, FsExecutor(args.fs_threads) as executor:
+        payload_files = sorted(updater.payload_files(executor=executor))
+        renamer.prefetch(sorted(set(os.path.dirname(filepath) for filepath in payload_files)), executor=executor)
+        rename_map = collections.OrderedDict(rename_files(payload_files, basedir=updater.path, rules=load_rules(args),
+                                                          out=StringIO(), renamer=renamer))
+        phase.update(files=bag.files)
+
+    with timer('pre-validate') as phase:
+        updater.validate_level(args.pre_validate, processes=args.processes)
+        if args.pre_validate == 'full':
+            phase.update(files=bag.files, bytes=bag.bytes)
+        else:
+            phase.update(files=bag.files)
+
+    if args.post_validate == 'rename':
+        # taken before the renames, as rename_bag_payload does
+        with timer('snapshot') as phase:
+            payload_stats = updater.payload_file_stats(rename_map.keys())
+            phase.update(files=len(rename_map))
+
+    # rename_bag_payload's own journalled rename and manifest update, its phases timed as it runs them
+    def update_manifests(on_manifest_rewritten):
+        updater.update_payload_filenames(rename_map=rename_map, processes=args.manifest_processes,
+                                         on_manifest_rewritten=on_manifest_rewritten)
+    metrics = TimedMetrics(timer, {'rename': {'files': len(rename_map)},
+                                   'manifest-rewrite': {'lines': bag.manifest_lines}})
+    rename_journalled(RenameJournal.for_bag(updater.path), updater.path, rename_map, len(rename_map), renamer,
+                      update_manifests, args, metrics, out=StringIO())
+
+    with timer('post-validate') as phase:
+        if args.post_validate == 'rename':
+            updater.validate_renamed(rename_map, payload_stats)
+            phase.update(files=len(rename_map))
+        else:
+            updater.refresh().validate(processes=args.processes)
+            phase.update(files=bag.files, bytes=bag.bytes)
+
+    with timer('walk') as phase, FsExecutor(args.fs_threads) as executor:
+        phase.update(files=sum(1 for item in walk_dir(updater.path, executor=executor) if item.type == 'file'))
+
+    if args.confirm_python is not None:
+        log_file = os.path.join(work_dir, 'renameLog.csv')
+        with io.open(log_file, 'w', encoding='utf-8') as f:
+            f.write('oldFileName,newFileName\n')
+            for old, new in rename_map.items():
+                f.write('%s,%s\n' % (os.path.join(updater.path, old), os.path.join(updater.path, new)))
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'confirmFileNameChanges.py')
+        with timer('confirm') as phase, open(os.devnull, 'wb') as devnull:
+            # the script prints every path and writes its report to the current directory
+            subprocess.check_call([args.confirm_python, script, '-d', updater.path, '-f', log_file],
+                                  cwd=work_dir, stdout=devnull)
+            phase.update(files=bag.files)
+
+    return collections.OrderedDict([
+        ('parameters', collections.OrderedDict(
+            (name, getattr(args, name)) for name in ('files', 'depth', 'fanout', 'size_distribution', 'size',
+                                                     'max_size', 'algorithms', 'tag_algorithms', 'seed', 'processes',
+                                                     'manifest_processes', 'post_validate', 'journal_batch_size'))),
+        ('environment', collections.OrderedDict([
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('cpus', multiprocessing.cpu_count()),
+            ('date', date.today().isoformat()),
+        ])),
+        ('bag', collections.OrderedDict([('files', bag.files), ('bytes', bag.bytes),
+                                         ('manifest_lines', bag.manifest_lines), ('renamed', len(rename_map))])),
+        ('phases', phases),
+        ('peak_rss_kb', peak_rss_kb()),
+    ])
+
+
+class PhaseTimer(object):
+    """Times phases into a dict of phase name to measurements.
+
+    Each phase is a context; the dict it yields takes the files, bytes and manifest lines the phase
+    processed, from which the rates are calculated. The peak RSS recorded is the process's (and its children's)
+    peak so far.
+    """
+
+    def __init__(self, phases):
+        self.phases = phases
+
+    def __call__(self, name):
+        return _Phase(self.phases, name)
+
+
+class _Phase(object):
+
+    def __init__(self, phases, name):
+        self.phases = phases
+        self.name = name
+        self.counts = {}
+
+    def __enter__(self):
+        self.start = time.time()
+        return self.counts
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            return
+        seconds = time.time() - self.start
+        phase = collections.OrderedDict([('seconds', round(seconds, 4))])
+        for count, rate, scale in (('files', 'files_per_s', 1), ('bytes', 'mb_per_s', MB), ('lines', 'lines_per_s', 1)):
+            if count in self.counts:
+                phase[count] = self.counts[count]
+                phase[rate] = round(self.counts[count] / scale / seconds, 1) if seconds > 0 else None
+        phase['peak_rss_kb'] = peak_rss_kb()
+        self.phases[self.name] = phase
+
+
+class TimedMetrics(Metrics):
+    """Metrics whose outermost phases are also timed by a PhaseTimer, with the given counts of each phase's
+    name, so that the phases of rename_bag_payload's functions are timed as they run them
+    """
+
+    def __init__(self, timer, counts):
+        super(TimedMetrics, self).__init__()
+        self.timer = timer
+        self.counts = counts
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self._phase_stack:
+            with super(TimedMetrics, self).phase(name):
+                yield self
+            return
+        with self.timer(name) as counts, super(TimedMetrics, self).phase(name):
+            counts.update(self.counts.get(name, {}))
+            yield self
+
+
+def make_bag(path, files, depth=3, fanout=10, sizes=None, algorithms=('md5', 'sha256'),
+             tag_algorithms=('md5', 'sha256')):
+    """Write a bag of the given number of payload files, spread evenly over the leaf directories of a tree
+    of the given depth and fan-out below data/, and return it as a SyntheticBag.
+
+    sizes is an iterator of file sizes (by default, 4KB each). The manifests are written as the files are,
+    from their contents, so generation reads nothing back.
+    """
+    if sizes is None:
+        sizes = iter(lambda: 4096, None)
+    leaves = [os.path.join(*(['data'] + ['dir%02d' % ((leaf // fanout ** level) % fanout)
+                                         for level in reversed(range(depth))]))
+              for leaf in range(fanout ** depth)]
+    # file contents are slices of one random block, led by the file's number so that no two are the same
+    block = b''.join(hashlib.sha512(('%d' % i).encode('ascii')).digest() for i in range(MB // 64))
+
+    os.makedirs(path)
+    total_bytes = 0
+    manifests = [io.open(os.path.join(path, 'manifest-%s.txt' % alg), 'w', encoding='utf-8') for alg in algorithms]
+    try:
+        for leaf in leaves[:files]:
+            os.makedirs(os.path.join(path, leaf))
+        for i in range(files):
+            relpath = os.path.join(leaves[i % len(leaves)], 'file%07d.dat' % i)
+            size = next(sizes)
+            hashes = [hashlib.new(alg) for alg in algorithms]
+            with open(os.path.join(path, relpath), 'wb') as f:
+                remaining = size
+                prefix = ('%d\n' % i).encode('ascii')[:remaining]
+                chunks = [prefix]
+                remaining -= len(prefix)
+                while remaining > 0:
+                    chunks.append(block[:remaining])
+                    remaining -= len(chunks[-1])
+                for chunk in chunks:
+                    f.write(chunk)
+                    for h in hashes:
+                        h.update(chunk)
+            for manifest, h in zip(manifests, hashes):
+                manifest.write('%s  %s\n' % (h.hexdigest(), relpath.replace(os.sep, '/')))
+            total_bytes += size
+    finally:
+        for manifest in manifests:
+            manifest.close()
+
+    with io.open(os.path.join(path, 'bagit.txt'), 'w', encoding='utf-8') as f:
+        f.write('BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n')
+    with io.open(os.path.join(path, 'bag-info.txt'), 'w', encoding='utf-8') as f:
+        f.write('Bagging-Date: %s\nPayload-Oxum: %d.%d\n' % (date.today().isoformat(), total_bytes, files))
+    tag_files = ['bagit.txt', 'bag-info.txt'] + ['manifest-%s.txt' % alg for alg in algorithms]
+    for alg in tag_algorithms:
+        with io.open(os.path.join(path, 'tagmanifest-%s.txt' % alg), 'w', encoding='utf-8') as f:
+            for tag_file in tag_files:
+                with open(os.path.join(path, tag_file), 'rb') as tag:
+                    f.write('%s  %s\n' % (hashlib.new(alg, tag.read()).hexdigest(), tag_file))
+    return SyntheticBag(path=os.path.abspath(path), files=files, bytes=total_bytes,
+                        manifest_lines=files * len(algorithms))
+
+
+def file_sizes(distribution='lognormal', mean=4096, max_size=64 * MB, seed=0):
+    """an endless iterator of file sizes of the given distribution and mean, capped at max_size"""
+    rng = random.Random(seed)
+    if distribution == 'fixed':
+        sample = lambda: mean
+    elif distribution == 'uniform':
+        sample = lambda: rng.randint(0, 2 * mean)
+    else:
+        # a long tail of large files, like most collections; sigma 1 gives the given mean
+        sigma = 1.0
+        mu = math.log(max(mean, 1)) - sigma ** 2 / 2
+        sample = lambda: int(rng.lognormvariate(mu, sigma))
+    while True:
+        yield min(sample(), max_size)
+
+
+def peak_rss_kb():
+    """the peak resident set size, in KB, of this process and of its largest child, or None if unknown"""
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # macOS reports bytes, Linux KB
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def print_results(results, out=sys.stdout):
+    bag = results['bag']
+    print('%d files (%d renamed), %.1f MB, %d manifest lines'
+          % (bag['files'], bag['renamed'], bag['bytes'] / MB, bag['manifest_lines']), file=out)
+    print('%-18s %10s %12s %10s %12s %12s' % ('Phase', 'Seconds', 'Files/s', 'MB/s', 'Lines/s', 'Peak RSS KB'),
+          file=out)
+    for name, phase in results['phases'].items():
+        print('%-18s %10.3f %12s %10s %12s %12s'
+              % (name, phase['seconds'], _rate(phase.get('files_per_s')), _rate(phase.get('mb_per_s')),
+                 _rate(phase.get('lines_per_s')), phase['peak_rss_kb'] or '-'), file=out)
+
+
+def print_comparison(results, baseline, out=sys.stdout):
+    """print each phase's time relative to the same phase in the baseline results"""
+    print('', file=out)
+    print('%-18s %10s %10s %8s' % ('Phase', 'Baseline', 'Seconds', 'Change'), file=out)
+    for name, phase in results['phases'].items():
+        before = baseline.get('phases', {}).get(name)
+        if before is None or not before['seconds']:
+            continue
+        print('%-18s %10.3f %10.3f %+7.1f%%' % (name, before['seconds'], phase['seconds'],
+                                                100 * (phase['seconds'] / before['seconds'] - 1)), file=out)
+    if baseline.get('parameters') != results['parameters']:
+        print('(the baseline was run with different parameters)', file=out)
+
+
+def _rate(rate):
+    return '-' if rate is None else '%.1f' % rate
+
+
+if __name__ == '__main__':
+    main()
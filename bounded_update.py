@@ -0,0 +1,179 @@
+"""Renaming a bag's payload and updating its manifests in bounded memory.
+
+Unlike bag_updater.Bag, nothing here holds a bag's manifest entries or payload file list in memory: they are
+put in external sorts (external_sort.SortedSpool) of run_size records at a time, and merge-joined with each
+other and with the sorted rename plan, so that peak memory doesn't grow with the number of payload files.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import bagit
+from bag_updater import TAG_MANIFEST_FILENAME_GLOB, file_digests, find_manifests, hash_entries, payload_files, \
+    tag_manifest_errors, update_tag_manifest_hashes
+from external_sort import DEFAULT_RUN_SIZE, SortedSpool, read_records
+import hashlib
+from instrumentation import Metrics
+import itertools
+import logging
+from manifest_rewriter import encode_filename, manifest_entries, rewrite_manifest_sorted
+import multiprocessing
+import os
+from safe_overwrite import OverwriteTransaction
+
+LOGGER = logging.getLogger(__name__)
+
+# payload files handed to the hashing processes at a time, so that they don't read ahead of the merge unboundedly
+HASH_WINDOW = 10000
+
+
+def sort_renames(renames, encoding='utf-8', run_size=DEFAULT_RUN_SIZE, tmp_dir=None):
+    """a finished SortedSpool of the (old, new) renames, encoded as the manifests are, in order of old filename"""
+    spool = SortedSpool(run_size=run_size, tmp_dir=tmp_dir)
+    try:
+        for old, new in renames:
+            spool.add((encode_filename(old, encoding), encode_filename(new, encoding)))
+        return spool.finish()
+    except:
+        spool.close()
+        raise
+
+
+def decoded_renames(sorted_renames, encoding='utf-8'):
+    """the renames of a sort_renames() spool as (old, new) text filenames"""
+    for old, new in sorted_renames:
+        yield old.decode(encoding), new.decode(encoding)
+
+
+def update_payload_filenames_sorted(bag_path, sorted_renames, encoding='utf-8', processes=1, rewritten_manifests=(),
+                                    on_manifest_rewritten=None, metrics=None, run_size=DEFAULT_RUN_SIZE, tmp_dir=None):
+    """As bag_updater.Bag.update_payload_filenames, in bounded memory, with the renames in a finished SortedSpool
+    from sort_renames() (which the worker processes read from its file)
+    """
+    if metrics is None:
+        metrics = Metrics()
+    if len(sorted_renames) == 0:
+        return
+    bag_path = os.path.abspath(bag_path)
+    tag_manifests = find_manifests(bag_path, TAG_MANIFEST_FILENAME_GLOB)
+    tag_algorithms = [tmf.algorithm for tmf in tag_manifests]
+
+    # rewritten, as bag_updater.Bag.update_payload_filenames does, as one transaction
+    with OverwriteTransaction(bag_path) as transaction:
+        pmf_hashes = {}
+        args = []
+        for pmf in find_manifests(bag_path):
+            if pmf.relpath in rewritten_manifests:
+                pmf_hashes[pmf.relpath] = file_digests(pmf.path, tag_algorithms)
+            else:
+                args.append((pmf.path, transaction.staged_path(pmf.path), pmf.relpath, sorted_renames.path,
+                             tag_algorithms, run_size, tmp_dir))
+
+        progress = metrics.progress('manifests_rewritten', total=len(args))
+        pool = None
+        if processes > 1 and len(args) > 1:
+            pool = multiprocessing.Pool(min(processes, len(args)))
+            updated = pool.imap_unordered(_update_payload_manifest_sorted, args)
+        else:
+            updated = (_update_payload_manifest_sorted(arg) for arg in args)
+        try:
+            for relpath, hashes, lines_rewritten in updated:
+                pmf_hashes[relpath] = hashes
+                metrics.count('manifest_lines_rewritten', lines_rewritten)
+                progress.update()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        for tmf in tag_manifests:
+            update_tag_manifest_hashes(tmf.path, new_hashes={relpath: hashes[tmf.algorithm]
+                                                             for relpath, hashes in pmf_hashes.items()},
+                                       encoding=encoding, output_file=transaction.staged_path(tmf.path))
+        transaction.commit()
+
+    if on_manifest_rewritten is not None:
+        for arg in args:
+            on_manifest_rewritten(arg[2])
+
+
+def _update_payload_manifest_sorted(args):
+    """(multiprocessing) worker: rewrite a payload manifest to its staged file, returning its relpath, its new
+    hash by each tag algorithm and the number of lines rewritten
+    """
+    manifest_file, output_file, relpath, renames_path, tag_algorithms, run_size, tmp_dir = args
+    hashes = [hashlib.new(alg) for alg in tag_algorithms]
+    lines_rewritten = rewrite_manifest_sorted(manifest_file, read_records(renames_path),
+                                              write_callbacks=[h.update for h in hashes], run_size=run_size,
+                                              tmp_dir=tmp_dir, output_file=output_file)
+    return relpath, {alg: h.hexdigest() for alg, h in zip(tag_algorithms, hashes)}, lines_rewritten
+
+
+def validate_sorted(bag_path, encoding='utf-8', hash_payload=True, processes=1, fixity_cache=None, metrics=None,
+                    run_size=DEFAULT_RUN_SIZE, tmp_dir=None):
+    """Validate a bag in bounded memory: its tag manifests; that its payload files and the entries of its payload
+    manifests match; and, with hash_payload, the payload files' checksums (trusting the fixity cache, if any, as
+    bag_updater.Bag does). The payload manifests' entries and the payload files are merge-joined in order of
+    filename, after external sorts. Raises bagit.BagValidationError on failure, otherwise returns True.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    bag_path = os.path.abspath(bag_path)
+
+    # tag manifests are small, so are checked in memory
+    errors = tag_manifest_errors(bag_path, find_manifests(bag_path, TAG_MANIFEST_FILENAME_GLOB), encoding=encoding)
+
+    with SortedSpool(run_size=run_size, tmp_dir=tmp_dir) as entries, \
+            SortedSpool(run_size=run_size, tmp_dir=tmp_dir) as files:
+        for pmf in find_manifests(bag_path):
+            for line_number, (hash, filename) in manifest_entries(pmf.path):
+                entries.add((_normalize_filename(filename, encoding), pmf.algorithm, hash.decode(encoding).lower()))
+        for payload_file in payload_files(bag_path):
+            files.add((encode_filename(payload_file.replace(os.sep, '/'), encoding),))
+
+        to_hash = _merge_payload(entries, files, errors, encoding)
+        if hash_payload:
+            to_hash = hash_entries(bag_path, ((filename.decode(encoding), hashes, list(hashes))
+                                              for filename, hashes in to_hash),
+                                   processes=processes, fixity_cache=fixity_cache, metrics=metrics, window=HASH_WINDOW)
+            for filename, f_hashes, hashes in to_hash:
+                for alg, computed_hash in f_hashes.items():
+                    if hashes[alg] != computed_hash:
+                        errors.append(bagit.ChecksumMismatch(filename, alg, hashes[alg], computed_hash))
+        else:
+            for _ in to_hash:
+                pass
+
+    for e in errors:
+        LOGGER.warning(str(e))
+    if errors:
+        raise bagit.BagValidationError('Bag validation failed', errors)
+    return True
+
+
+def _normalize_filename(filename, encoding):
+    """a manifest entry's filename, as bagit reads it, as bytes"""
+    filename = filename.strip().lstrip(b'*')
+    if b'%' in filename:
+        filename = encode_filename(bagit._decode_filename(filename.decode(encoding)), encoding)
+    return os.path.normpath(filename)
+
+
+def _merge_payload(entries, files, errors, encoding):
+    """merge-join the sorted (filename, algorithm, hash) manifest entries with the sorted (filename,) payload
+    files, adding an error for each file missing from either, and yielding (filename, {algorithm: hash}) for
+    each file in both
+    """
+    files = iter(files)
+    file_record = next(files, None)
+    for filename, group in itertools.groupby(entries, key=lambda entry: entry[0]):
+        while file_record is not None and file_record[0] < filename:
+            errors.append(bagit.UnexpectedFile(file_record[0].decode(encoding)))
+            file_record = next(files, None)
+        if file_record is not None and file_record[0] == filename:
+            file_record = next(files, None)
+            yield filename, {alg: hash for _, alg, hash in group}
+        else:
+            errors.append(bagit.FileMissing(filename.decode(encoding)))
+    while file_record is not None:
+        errors.append(bagit.UnexpectedFile(file_record[0].decode(encoding)))
+        file_record = next(files, None)
@@ -0,0 +1,209 @@
+from __future__ import print_function, unicode_literals
+
+import collections
+import errno
+import os
+
+RenameConflict = collections.namedtuple('RenameConflict', ['old', 'new', 'reason'])
+
+# renames can be made relative to open directories, saving a path lookup of each directory per rename
+DIR_FD_RENAME = getattr(os, 'supports_dir_fd', None) is not None and os.rename in os.supports_dir_fd and \
+    hasattr(os, 'O_DIRECTORY')
+
+# directories kept open for renames at a time
+MAX_DIR_FDS = 64
+
+
+class _Snapshot(object):
+    __slots__ = ('names', 'claimed', 'fold')
+
+    def __init__(self, names, case_insensitive=False):
+        # on a case-insensitive filesystem, names that differ only in case are the same name
+        self.fold = _fold_case if case_insensitive else _same
+        self.names = set(map(self.fold, names))
+        # the new names that planned renames will give files in the directory
+        self.claimed = set()
+
+
+class BulkRenamer(object):
+    """Plans and makes the renames of many files below basedir (all paths relative to it).
+
+    plan() checks each rename against one listing (snapshot) of each directory involved, taken the first
+    time it's needed, rather than checking the paths one at a time: the old name must be in its directory,
+    and the new name neither in its directory nor the new name of another planned rename (ignoring case, on a
+    case-insensitive filesystem). Conflicts are collected in self.conflicts. rename() then makes a planned
+    rename, relative to open directory file descriptors where the platform supports it, but never over a file
+    that has taken the new name since the snapshot. With max_snapshots, only that many directories' snapshots
+    are kept, least recently used first out, which suits planning in walk (directory) order in bounded memory;
+    a directory's snapshot, and its claimed names, are only reliable while it's kept.
+
+    With an fs_executor.FsExecutor, prefetch() takes many directories' snapshots, and rename_many() makes many
+    renames, at once, for high-latency filesystems; their results, and conflicts, are in order as without one.
+    """
+
+    def __init__(self, basedir='', max_snapshots=None):
+        self.basedir = basedir
+        self.max_snapshots = max_snapshots
+        self.conflicts = []
+        self._snapshots = collections.OrderedDict()
+        self._dir_fds = collections.OrderedDict()
+        # whether the filesystem is case-insensitive, once a directory's listing has told
+        self._case_insensitive = None
+
+    def plan(self, old, new):
+        """whether old can be renamed to new; if so, new is claimed, so that no other rename is planned to it"""
+        old_parent, old_name = os.path.split(old)
+        new_parent, new_name = os.path.split(new)
+        if old == new:
+            return self._conflict(old, new, 'the new name is the same')
+        old_snapshot = self._snapshot(old_parent)
+        if old_snapshot is None or old_snapshot.fold(old_name) not in old_snapshot.names:
+            return self._conflict(old, new, 'it does not exist')
+        new_snapshot = self._snapshot(new_parent)
+        if new_snapshot is None:
+            return self._conflict(old, new, 'the new directory does not exist')
+        folded_name = new_snapshot.fold(new_name)
+        # (a rename only in case is of the file to itself)
+        if folded_name in new_snapshot.names and not (old_parent == new_parent and
+                                                      folded_name == new_snapshot.fold(old_name)):
+            return self._conflict(old, new, 'the new name exists')
+        if folded_name in new_snapshot.claimed:
+            return self._conflict(old, new, 'the new name is planned for another file')
+        new_snapshot.claimed.add(folded_name)
+        return True
+
+    def rename(self, old, new):
+        """make a planned rename, returning whether it succeeded (any error is added to self.conflicts)"""
+        try:
+            if DIR_FD_RENAME:
+                old_parent, old_name = os.path.split(old)
+                new_parent, new_name = os.path.split(new)
+                _rename_no_replace(old_name, new_name, src_dir_fd=self._dir_fd(old_parent),
+                                   dst_dir_fd=self._dir_fd(new_parent))
+            else:
+                _rename_no_replace(os.path.join(self.basedir, old), os.path.join(self.basedir, new))
+        except OSError as e:
+            return self._conflict(old, new, str(e))
+        return True
+
+    def rename_many(self, renames, executor=None):
+        """make a list of planned (old, new) renames, returning whether each succeeded; with an executor, up to
+        its depth at a time (by path, as the directories' file descriptors are kept by one thread)
+        """
+        if executor is None or executor.depth == 1:
+            return [self.rename(old, new) for old, new in renames]
+        paths = [(os.path.join(self.basedir, old), os.path.join(self.basedir, new)) for old, new in renames]
+        renamed = []
+        for (old, new), result in zip(renames, executor.map(_rename_no_replace, paths)):
+            if result.error is not None:
+                renamed.append(self._conflict(old, new, str(result.error)))
+            else:
+                renamed.append(True)
+        return renamed
+
+    def prefetch(self, parents, executor=None):
+        """take the snapshots of the directories parents that aren't yet taken; with an executor, up to its
+        depth at a time
+        """
+        if executor is None:
+            return
+        parents = [parent for parent in parents if parent not in self._snapshots]
+        listings = executor.map(os.listdir, [os.path.join(self.basedir, parent) or '.' for parent in parents])
+        for parent, result in zip(parents, listings):
+            # a directory that can't be listed is left to plan(), as it will be again
+            if result.error is None:
+                self._keep_snapshot(parent, self._new_snapshot(parent, result.value))
+
+    def close(self):
+        """close the directories opened by rename(); the snapshots are kept"""
+        while self._dir_fds:
+            os.close(self._dir_fds.popitem()[1])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _conflict(self, old, new, reason):
+        self.conflicts.append(RenameConflict(old=old, new=new, reason=reason))
+        return False
+
+    def _snapshot(self, parent):
+        snapshot = self._snapshots.pop(parent, None)
+        if snapshot is None:
+            try:
+                snapshot = self._new_snapshot(parent, os.listdir(os.path.join(self.basedir, parent) or '.'))
+            except OSError:
+                return None
+        self._keep_snapshot(parent, snapshot)
+        return snapshot
+
+    def _new_snapshot(self, parent, names):
+        if self._case_insensitive is None:
+            self._case_insensitive = _case_insensitive(os.path.join(self.basedir, parent), names)
+        return _Snapshot(names, case_insensitive=bool(self._case_insensitive))
+
+    def _keep_snapshot(self, parent, snapshot):
+        if self.max_snapshots is not None and len(self._snapshots) >= self.max_snapshots:
+            self._snapshots.popitem(last=False)
+        self._snapshots[parent] = snapshot
+
+    def _dir_fd(self, parent):
+        fd = self._dir_fds.pop(parent, None)
+        if fd is None:
+            fd = os.open(os.path.join(self.basedir, parent) or '.', os.O_RDONLY | os.O_DIRECTORY)
+            if len(self._dir_fds) >= MAX_DIR_FDS:
+                os.close(self._dir_fds.popitem(last=False)[1])
+        self._dir_fds[parent] = fd
+        return fd
+
+
+def _rename_no_replace(old, new, src_dir_fd=None, dst_dir_fd=None):
+    """os.rename, but raising OSError (EEXIST) rather than replacing a file that has the new name, unless it's
+    the file itself under a name differing only in case, on a case-insensitive filesystem
+    """
+    try:
+        new_stat = _lstat(new, dst_dir_fd)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    else:
+        if _fold_case(old) != _fold_case(new) or not _same_file(_lstat(old, src_dir_fd), new_stat):
+            raise OSError(errno.EEXIST, 'the new name exists', new)
+    if src_dir_fd is None and dst_dir_fd is None:
+        os.rename(old, new)
+    else:
+        os.rename(old, new, src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+
+
+def _case_insensitive(path, names):
+    """whether the directory path, with the entries names, is on a case-insensitive filesystem, or None if its
+    entries can't tell
+    """
+    names = set(names)
+    for name in names:
+        other = name.swapcase()
+        if other == name or other in names:
+            continue
+        try:
+            return _same_file(os.lstat(os.path.join(path, name)), os.lstat(os.path.join(path, other)))
+        except OSError:
+            return False
+    return None
+
+
+def _lstat(path, dir_fd=None):
+    return os.lstat(path) if dir_fd is None else os.lstat(path, dir_fd=dir_fd)
+
+
+def _same_file(st1, st2):
+    return (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino)
+
+
+def _fold_case(name):
+    return name.lower()
+
+
+def _same(name):
+    return name
@@ -1,60 +1,59 @@
-import os
-import csv
-from datetime import datetime
-import time
-import argparse
-
-parser = argparse.ArgumentParser()
-parser.add_argument('-d', '--directory', help='the directory of the files to be renamed. optional - if not provided, the script will ask for input')
-parser.add_argument('-f', '--fileNameCSV', help='the CSV file of name changes. optional - if not provided, the script will ask for input')
-
-args = parser.parse_args()
-
-if args.directory:
-    directory = args.directory
-else:
-    directory = raw_input('Enter the directory of the files that was renamed: ')
-if args.fileNameCSV:
-    fileNameCSV = args.fileNameCSV
-else:
-    fileNameCSV = raw_input('Enter the CSV file of renameLog (including \'.csv\'): ')
-
-startTime = time.time()
-f=csv.writer(open('renameConfirmation'+datetime.now().strftime('%Y-%m-%d %H.%M.%S')+'.csv','wb'))
-f.writerow(['newFileName']+['confirmation']) #This section opens the renamelog csv and checks to make sure all the updated file paths logged in the csv exist in the directory
-with open(fileNameCSV) as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        updatedFilePath = row['newFileName']
-        if os.path.isfile(updatedFilePath) is True:
-            confirm = 'changes made'
-            f.writerow([updatedFilePath]+[confirm])
-        else:
-            confirm = 'FILE PATH DOES NOT EXIST'
-            f.writerow([updatedFilePath]+[confirm])
-f.writerow([]+[])
-f.writerow(['currentPaths'] + ['confirmation'])
-
-updateFilePaths = []
-
-with open(fileNameCSV) as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        updatedFilePath = row['newFileName']
-        updateFilePaths.append(updatedFilePath)
-
-
-for filePath, subFolders, fileNames in os.walk(directory, topdown=True):
-    for fileName in fileNames: #this section checks to see if there are any file paths in the directory that aren't in the renamelog csv
-        currentPath = os.path.join(filePath,fileName)
-        print currentPath
-        if currentPath in updateFilePaths:
-            continue
-        else:
-            confirm = 'not found in renameLog'
-            f.writerow([currentPath] + [confirm])
-
-elapsedTime = time.time() - startTime
-m, s = divmod(elapsedTime, 60)
-h, m = divmod(m, 60)
-print 'Total script run time: ', '%d:%02d:%02d' % (h, m, s)
+import os
+from datetime import datetime
+import time
+import argparse
+from fs_executor import FsExecutor
+from rename_log import LOG_COMPRESSIONS, LOG_FORMATS, RenameLogReader, RenameLogWriter, log_filename
+from walker import walk_dir
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--directory', help='the directory of the files to be renamed. optional - if not provided, the script will ask for input')
+parser.add_argument('-f', '--fileNameCSV', help='the renameLog of name changes, of any format and compression. optional - if not provided, the script will ask for input')
+parser.add_argument('-t', '--threads', type=int, default=1, help='directories to list at once, for network filesystems. optional - default 1')
+parser.add_argument('-l', '--logFormat', choices=LOG_FORMATS, default='csv', help='the format of the confirmation log. optional - default csv')
+parser.add_argument('-z', '--logCompression', choices=LOG_COMPRESSIONS, default='none', help='the compression of the confirmation log (zstd needs the zstandard package). optional - default none')
+
+args = parser.parse_args()
+
+if args.directory:
+    directory = args.directory
+else:
+    directory = raw_input('Enter the directory of the files that was renamed: ')
+if args.fileNameCSV:
+    fileNameCSV = args.fileNameCSV
+else:
+    fileNameCSV = raw_input('Enter the renameLog file (including its extension, e.g. \'.csv\'): ')
+
+startTime = time.time()
+# the logged paths, normalised so that e.g. 'dir//a', './dir/a' and 'dir/a' match. a binary renamelog is
+# memory-mapped and its column read a run of rows at a time, without parsing CSV
+with RenameLogReader(fileNameCSV) as reader:
+    unfoundFilePaths = set(os.path.normpath(path) for path in reader.column('newFileName') if path)
+
+logFileName = log_filename('renameConfirmation'+datetime.now().strftime('%Y-%m-%d %H.%M.%S'), args.logFormat, args.logCompression)
+with RenameLogWriter(logFileName, ['newFileName', 'confirmation'], format=args.logFormat, compression=args.logCompression) as f:
+    # a single walk of the directory confirms each file as it's found, whether it's in the renamelog or not.
+    # paths are joined to the directory as given, as the ones in the renamelog are
+    with FsExecutor(args.threads) as executor:
+        for item in walk_dir(directory, absolute=False, executor=executor):
+            if item.type != 'file':
+                continue
+            currentPath = item.path
+            print currentPath
+            normalisedPath = os.path.normpath(currentPath)
+            if normalisedPath in unfoundFilePaths:
+                unfoundFilePaths.discard(normalisedPath)
+                confirm = 'changes made'
+            else:
+                confirm = 'not found in renameLog'
+            f.writerow([currentPath, confirm])
+    #then the logged file paths that weren't found, in the renamelog's order, reading it again rather than keeping it
+    with RenameLogReader(fileNameCSV) as reader:
+        for updatedFilePath in reader.column('newFileName'):
+            if updatedFilePath and os.path.normpath(updatedFilePath) in unfoundFilePaths:
+                f.writerow([updatedFilePath, 'FILE PATH DOES NOT EXIST'])
+
+elapsedTime = time.time() - startTime
+m, s = divmod(elapsedTime, 60)
+h, m = divmod(m, 60)
+print 'Total script run time: ', '%d:%02d:%02d' % (h, m, s)
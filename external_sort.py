@@ -0,0 +1,112 @@
+from __future__ import print_function, unicode_literals
+
+import heapq
+import marshal
+import os
+import tempfile
+
+# records held in memory before a sorted run of them is spilled to disk
+DEFAULT_RUN_SIZE = 500000
+
+
+class SortedSpool(object):
+    """An external sort of records (tuples of bytes, str or ints), in bounded memory.
+
+    Records are add()ed in any order and held in memory until run_size of them have been added, when
+    they are sorted and spilled to a temporary file as a run. finish() merges the runs into a single
+    sorted file, which can then be iterated over as often as needed, or read by other processes with
+    read_records(spool.path). The temporary files are removed by close().
+    """
+
+    def __init__(self, run_size=DEFAULT_RUN_SIZE, tmp_dir=None):
+        self.run_size = run_size
+        self.tmp_dir = tmp_dir
+        self.path = None
+        self._records = []
+        self._runs = []
+        self._count = 0
+
+    def add(self, record):
+        self._records.append(record)
+        self._count += 1
+        if len(self._records) >= self.run_size:
+            self._spill()
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+
+    def finish(self):
+        """sort what has been added into a single file at self.path; nothing more can be added"""
+        if self.path is not None:
+            return self
+        self._spill()
+        if len(self._runs) == 1:
+            self.path = self._runs.pop()
+        else:
+            # every run holds run_size records, so the number merged at once grows slowly with the total
+            self.path = self._write(heapq.merge(*[read_records(run) for run in self._runs]))
+            for run in self._runs:
+                os.remove(run)
+            self._runs = []
+        return self
+
+    def close(self):
+        for path in self._runs + ([self.path] if self.path is not None else []):
+            if os.path.exists(path):
+                os.remove(path)
+        self._runs = []
+        self._records = []
+        self.path = None
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return read_records(self.finish().path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _spill(self):
+        if self._records or not self._runs:
+            self._records.sort()
+            self._runs.append(self._write(self._records))
+            self._records = []
+
+    def _write(self, records):
+        fd, path = tempfile.mkstemp(prefix='sorted-spool-', suffix='.run', dir=self.tmp_dir)
+        with os.fdopen(fd, 'wb') as f:
+            for record in records:
+                # marshal, since the files only live for this run of this Python
+                marshal.dump(record, f)
+        return path
+
+
+def read_records(path):
+    """iterate over the records of a spool file, as written by SortedSpool"""
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+
+def merge_join(left, right):
+    """join two iterators of records sorted by their first field, yielding (left record, right record) for each
+    pair with the same first field (both for each of any duplicates on the right, but only the first of
+    any duplicates on the left)
+    """
+    right = iter(right)
+    right_record = next(right, None)
+    for left_record in left:
+        key = left_record[0]
+        while right_record is not None and right_record[0] < key:
+            right_record = next(right, None)
+        while right_record is not None and right_record[0] == key:
+            yield left_record, right_record
+            right_record = next(right, None)
@@ -0,0 +1,78 @@
+from __future__ import print_function, unicode_literals
+
+import sqlite3
+
+
+def stat_key(st):
+    """the (st_dev, st_ino, st_size, st_mtime_ns) tuple that a cached digest is valid for"""
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1000000000))
+    return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+
+def _int64(value):
+    # sqlite integers are signed 64-bit, but device and inode numbers may use the full unsigned range
+    return value - 2 ** 64 if value >= 2 ** 63 else value
+
+
+class FixityCache(object):
+    """On-disk (SQLite) cache of file digests, keyed by device and inode.
+
+    A cached digest is only returned while the file's size and mtime still match the ones it was
+    recorded with; rows that no longer match are evicted when they are looked up. With trust=False
+    nothing is returned from the cache, but newly calculated digests are still recorded, so that a
+    fresh fixity audit also refreshes the cache.
+    """
+
+    def __init__(self, path, trust=True, timeout=60):
+        self.path = path
+        self.trust = trust
+        # the timeout lets bags processed concurrently share the cache, waiting on each other's writes
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS digests ('
+                                ' dev INTEGER NOT NULL, ino INTEGER NOT NULL,'
+                                ' size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,'
+                                ' algorithm TEXT NOT NULL, digest TEXT NOT NULL,'
+                                ' PRIMARY KEY (dev, ino, algorithm))')
+        self.connection.commit()
+
+    def get(self, key, algorithms):
+        """map of algorithm to cached digest for the file with the given stat_key()"""
+        if not self.trust:
+            return {}
+        dev, ino, size, mtime_ns = key
+        dev, ino = _int64(dev), _int64(ino)
+        digests = {}
+        stale = False
+        for row_size, row_mtime_ns, algorithm, digest in self.connection.execute(
+                'SELECT size, mtime_ns, algorithm, digest FROM digests WHERE dev = ? AND ino = ?', (dev, ino)):
+            if (row_size, row_mtime_ns) != (size, mtime_ns):
+                stale = True
+            elif algorithm in algorithms:
+                digests[algorithm] = digest
+        if stale:
+            self.connection.execute('DELETE FROM digests WHERE dev = ? AND ino = ? AND (size != ? OR mtime_ns != ?)',
+                                    (dev, ino, size, mtime_ns))
+        return digests
+
+    def put(self, key, digests):
+        dev, ino, size, mtime_ns = key
+        dev, ino = _int64(dev), _int64(ino)
+        self.connection.execute('DELETE FROM digests WHERE dev = ? AND ino = ? AND (size != ? OR mtime_ns != ?)',
+                                (dev, ino, size, mtime_ns))
+        self.connection.executemany('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)',
+                                    [(dev, ino, size, mtime_ns, alg, digest) for alg, digest in digests.items()])
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,66 @@
+from __future__ import print_function, unicode_literals
+
+import collections
+from multiprocessing.pool import ThreadPool
+
+FsResult = collections.namedtuple('FsResult', ['item', 'value', 'error'])
+
+# requests in flight at a time by default: enough to hide the latency of a network filesystem
+DEFAULT_DEPTH = 16
+
+
+class FsExecutor(object):
+    """Runs filesystem calls (stat, scandir, rename...) on a pool of threads, with up to depth of them in flight.
+
+    The calls spend their time waiting on the filesystem, with the GIL released, so on high-latency
+    (network) filesystems many in flight at once take little longer than one. Results are returned in the
+    order of the requests, and an OSError (or IOError) is returned with its request rather than raised, so
+    that callers behave just as when making the calls one at a time. A depth of 1 makes the calls in the
+    calling thread.
+    """
+
+    def __init__(self, depth=DEFAULT_DEPTH):
+        self.depth = depth
+        self._pool = ThreadPool(depth) if depth > 1 else None
+
+    def submit(self, func, *args):
+        """start func(*args), returning a callable that waits for and returns its FsResult (item being args)"""
+        if self._pool is None:
+            result = _call(func, args)
+            return lambda: result
+        async_result = self._pool.apply_async(_call, (func, args))
+        return async_result.get
+
+    def map(self, func, items):
+        """yield the FsResult of func(item) for each of items, in order, with up to depth calls in flight"""
+        if self._pool is None:
+            for item in items:
+                yield _call(func, item)
+            return
+        pending = collections.deque()
+        for item in items:
+            pending.append(self._pool.apply_async(_call, (func, item)))
+            if len(pending) >= self.depth:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _call(func, item):
+    try:
+        value = func(*item) if isinstance(item, tuple) else func(item)
+    except (OSError, IOError) as e:
+        return FsResult(item=item, value=None, error=e)
+    return FsResult(item=item, value=value, error=None)
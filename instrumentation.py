@@ -0,0 +1,117 @@
+from __future__ import division, print_function, unicode_literals
+
+import collections
+import contextlib
+import os
+import re
+import sys
+import time
+
+ProgressReport = collections.namedtuple('ProgressReport', ['phase', 'counter', 'done', 'total', 'elapsed', 'rate',
+                                                           'eta'])
+
+
+class Metrics(object):
+    """Phase timings, counters and progress reporting for the operations on a bag.
+
+    Phases are timed with phase(); their times accumulate if a phase is entered more than once. Counters
+    are incremented with count(), or by the Progress objects of progress(), which also call each of the
+    progress_callbacks with a ProgressReport at most every progress_interval seconds. With a profile_dir,
+    each (outermost) phase is run under cProfile and its stats are dumped to
+    <profile_dir>/<profile_prefix><phase>.prof.
+    """
+
+    def __init__(self, progress_callbacks=None, progress_interval=60, profile_dir=None, profile_prefix=''):
+        self.phases = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.progress_callbacks = list(progress_callbacks or [])
+        self.progress_interval = progress_interval
+        self.profile_dir = profile_dir
+        self.profile_prefix = profile_prefix
+        self._phase_stack = []
+
+    @property
+    def current_phase(self):
+        return self._phase_stack[-1] if self._phase_stack else None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        profiler = None
+        if self.profile_dir is not None and not self._phase_stack:
+            import cProfile
+            profiler = cProfile.Profile()
+        self._phase_stack.append(name)
+        start = time.time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield self
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+            self._phase_stack.pop()
+            if profiler is not None:
+                profiler.dump_stats(os.path.join(self.profile_dir, '%s%s.prof'
+                                                 % (self.profile_prefix, re.sub(r'[^\w.-]', '_', name))))
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def progress(self, counter, total=None):
+        """a Progress of the given counter in the current phase, out of total (if known)"""
+        return Progress(self, counter, total)
+
+    def as_dict(self):
+        return collections.OrderedDict([
+            ('phases', collections.OrderedDict((name, round(seconds, 4)) for name, seconds in self.phases.items())),
+            ('counters', collections.OrderedDict(sorted(self.counters.items()))),
+        ])
+
+
+class Progress(object):
+    """Counts the progress of a phase, reporting it to the metrics' progress callbacks periodically."""
+
+    def __init__(self, metrics, counter, total=None):
+        self.metrics = metrics
+        self.counter = counter
+        self.total = total
+        self.phase = metrics.current_phase
+        self.done = 0
+        self.start = time.time()
+        self._next_report = self.start + metrics.progress_interval
+
+    def update(self, n=1):
+        self.done += n
+        self.metrics.counters[self.counter] += n
+        # the callbacks are only checked for now and then, so that this stays cheap per file
+        if self.metrics.progress_callbacks and time.time() >= self._next_report:
+            self.report()
+
+    def report(self):
+        now = time.time()
+        self._next_report = now + self.metrics.progress_interval
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else None
+        eta = (self.total - self.done) / rate if self.total is not None and rate else None
+        report = ProgressReport(phase=self.phase, counter=self.counter, done=self.done, total=self.total,
+                                elapsed=elapsed, rate=rate, eta=eta)
+        for callback in self.metrics.progress_callbacks:
+            callback(report)
+
+
+def print_progress(prefix='', out=sys.stderr):
+    """a progress callback printing each report, led by prefix, to out"""
+    def callback(report):
+        done = '%d/%d' % (report.done, report.total) if report.total is not None else '%d' % report.done
+        rate = '%.1f/s' % report.rate if report.rate is not None else '-/s'
+        eta = ', ETA %s' % format_duration(report.eta) if report.eta is not None else ''
+        print('%s%s: %s %s (%s%s)' % (prefix, report.phase, done, report.counter, rate, eta), file=out)
+        out.flush()
+    return callback
+
+
+def format_duration(seconds):
+    m, s = divmod(int(round(seconds)), 60)
+    h, m = divmod(m, 60)
+    return '%d:%02d:%02d' % (h, m, s)
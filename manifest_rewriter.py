@@ -0,0 +1,198 @@
+from __future__ import print_function, unicode_literals
+
+from external_sort import DEFAULT_RUN_SIZE, SortedSpool, merge_join
+from safe_overwrite import safe_overwrite
+
+# manifests are read, and rewritten lines are written and fed to the write callbacks, in blocks of about this size
+BLOCK_SIZE = 1024 * 1024
+
+
+def rewrite_manifest(manifest_file, new_filenames=None, new_hashes=None, write_callbacks=None, encoding='utf-8',
+                     block_size=BLOCK_SIZE, output_file=None):
+    """Rewrite a manifest file in place, renaming the files in new_filenames (old to new filename) and/or
+    replacing the hashes of the files in new_hashes (filename to hash).
+
+    The manifest is processed as bytes: each line is split once on its first run of whitespace, and only the
+    lines whose filename is in one of the maps are rebuilt; all other bytes are copied as they are, except that
+    an entry on a last line without a newline gets one. Each block of output is also passed to the
+    write_callbacks (e.g. the update methods of hashlib objects). Returns the number of lines rewritten.
+    With output_file (e.g. a safe_overwrite.OverwriteTransaction's staged file), the rewritten manifest is
+    written to it instead, leaving the manifest as it is.
+    """
+    new_filenames = encode_map(new_filenames, encoding)
+    return _rewrite(manifest_file, lambda lines, first_line: new_filenames, encode_map(new_hashes, encoding),
+                    write_callbacks, block_size, output_file)
+
+
+def rewrite_manifest_sorted(manifest_file, sorted_renames, write_callbacks=None, block_size=BLOCK_SIZE,
+                            run_size=DEFAULT_RUN_SIZE, tmp_dir=None, output_file=None):
+    """As rewrite_manifest, renaming files as in sorted_renames, but in bounded memory however many there are.
+
+    sorted_renames is an iterable of (old, new) filenames, as bytes in the manifest's encoding, sorted by
+    old filename (e.g. an external_sort.SortedSpool). It is merge-joined with the manifest's entries: as it is
+    read, if they are in order of filename, or else after sorting (filename, line number) for each entry with
+    an external sort, of run_size records at a time in tmp_dir, and sorting the joined renames back into
+    line order. Returns the number of lines rewritten.
+    """
+    if _entries_sorted(manifest_file):
+        block_filenames = _MergedRenames(sorted_renames)
+        return _rewrite(manifest_file, block_filenames, {}, write_callbacks, block_size, output_file)
+    with SortedSpool(run_size=run_size, tmp_dir=tmp_dir) as entries, \
+            SortedSpool(run_size=run_size, tmp_dir=tmp_dir) as line_renames:
+        entries.extend((fields[1], line_number) for line_number, fields in manifest_entries(manifest_file))
+        for (old, new), (filename, line_number) in merge_join(sorted_renames, entries):
+            line_renames.add((line_number, old, new))
+        return _rewrite(manifest_file, _LineRenames(line_renames), {}, write_callbacks, block_size, output_file)
+
+
+def _rewrite(manifest_file, block_filenames, new_hashes, write_callbacks, block_size, output_file=None):
+    """rewrite the manifest (to output_file, if given), renaming the entries of each block of lines as in the
+    map that block_filenames(lines, first line number) returns for it
+    """
+    if write_callbacks is None:
+        write_callbacks = []
+    output = safe_overwrite(manifest_file, text=False) if output_file is None else open(output_file, 'wb')
+    with open(manifest_file, 'rb') as manifest, output as new_manifest:
+        rewritten = 0
+        line_number = 0
+        remainder = b''
+        for block in iter(lambda: manifest.read(block_size), b''):
+            lines = (remainder + block).split(b'\n')
+            # the last piece is an incomplete line, or empty if the block ended with a newline
+            remainder = lines.pop()
+            rewritten += _rewrite_lines(lines, block_filenames(lines, line_number), new_hashes)
+            line_number += len(lines)
+            lines.append(b'')
+            _write(b'\n'.join(lines), new_manifest, write_callbacks)
+        if remainder:
+            lines = [remainder]
+            rewritten += _rewrite_lines(lines, block_filenames(lines, line_number), new_hashes)
+            if _entry_fields(remainder) is not None:
+                lines.append(b'')
+            _write(b'\n'.join(lines), new_manifest, write_callbacks)
+    return rewritten
+
+
+class _MergedRenames(object):
+    """the renames, from sorted (old, new) renames, of the entries in each of a sequence of blocks of lines whose
+    entries are in order of filename
+    """
+
+    def __init__(self, sorted_renames):
+        self.renames = iter(sorted_renames)
+        self.rename = next(self.renames, None)
+
+    def __call__(self, lines, first_line):
+        filenames = [fields[1] for fields in map(_entry_fields, lines) if fields is not None]
+        block_renames = {}
+        if filenames:
+            first, last = filenames[0], filenames[-1]
+            while self.rename is not None and self.rename[0] <= last:
+                if self.rename[0] >= first:
+                    block_renames[self.rename[0]] = self.rename[1]
+                if self.rename[0] == last:
+                    # kept for the next block, which may start with more entries of the same filename
+                    break
+                self.rename = next(self.renames, None)
+        return block_renames
+
+
+class _LineRenames(object):
+    """the renames, from (line number, old, new) renames sorted by line number, of each of a sequence of blocks
+    of lines
+    """
+
+    def __init__(self, line_renames):
+        self.renames = iter(line_renames)
+        self.rename = next(self.renames, None)
+
+    def __call__(self, lines, first_line):
+        end = first_line + len(lines)
+        block_renames = {}
+        while self.rename is not None and self.rename[0] < end:
+            block_renames[self.rename[1]] = self.rename[2]
+            self.rename = next(self.renames, None)
+        return block_renames
+
+
+def manifest_entries(manifest_file):
+    """(line number, (hash, filename)) of each entry of the manifest"""
+    with open(manifest_file, 'rb') as manifest:
+        for line_number, line in enumerate(manifest):
+            fields = _entry_fields(line.rstrip(b'\n'))
+            if fields is not None:
+                yield line_number, fields
+
+
+def _entries_sorted(manifest_file):
+    previous = None
+    for line_number, (hash, filename) in manifest_entries(manifest_file):
+        if previous is not None and filename < previous:
+            return False
+        previous = filename
+    return True
+
+
+def _rewrite_lines(lines, new_filenames, new_hashes):
+    """rewrite, in place, the manifest entry lines (without newlines) whose filename is in either map, returning
+    how many were rewritten
+    """
+    # this is the hot loop, so look the filename up before checking that the line is a well-formed entry
+    get_new_filename = new_filenames.get
+    get_new_hash = new_hashes.get
+    rewritten = 0
+    for i, line in enumerate(lines):
+        fields = line.split(None, 1)
+        if len(fields) != 2:
+            continue
+        hash, filename = fields
+        new_filename = get_new_filename(filename)
+        new_hash = get_new_hash(filename)
+        if (new_filename is None and new_hash is None) or line[:1].isspace():
+            continue
+        # keep the separating whitespace as it is
+        spaces = line[len(hash):len(line) - len(filename)]
+        lines[i] = (hash if new_hash is None else new_hash) + spaces + \
+            (filename if new_filename is None else new_filename)
+        rewritten += 1
+    return rewritten
+
+
+def _entry_fields(line):
+    """(hash, filename) of a manifest entry line, or None for anything else (blank, indented...)"""
+    if not line or line[:1].isspace():
+        return None
+    fields = line.split(None, 1)
+    return fields if len(fields) == 2 else None
+
+
+def _write(output, f, write_callbacks):
+    for callback in write_callbacks:
+        callback(output)
+    f.write(output)
+
+
+def encode_filename(filename, encoding='utf-8'):
+    """the filename encoded to bytes, as rewrite_manifest() and rewrite_manifest_sorted() use it"""
+    return _encode(filename, encoding)
+
+
+def encode_map(mapping, encoding='utf-8'):
+    """the mapping with its keys and values encoded to bytes, as rewrite_manifest() uses it
+
+    To rewrite several manifests with the same map, encode it once with this and pass the result.
+    """
+    if not mapping:
+        return {}
+    for key, value in mapping.items():
+        if isinstance(key, bytes) and isinstance(value, bytes):
+            return mapping
+        if not isinstance(key, bytes) and not isinstance(value, bytes):
+            return {k.encode(encoding): v.encode(encoding) for k, v in mapping.items()}
+        break
+    # a mix, as under Python 2 with str paths and unicode new names
+    return {_encode(k, encoding): _encode(v, encoding) for k, v in mapping.items()}
+
+
+def _encode(s, encoding):
+    return s if isinstance(s, bytes) else s.encode(encoding)
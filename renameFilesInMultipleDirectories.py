@@ -3,11 +3,15 @@ import csv
 from datetime import datetime
 import time
 import argparse
+from rename_log import LOG_COMPRESSIONS, LOG_FORMATS, RenameLogWriter, log_filename
+from walker import walk_dir
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-d', '--directory', help='the directory of the files to be renamed. optional - if not provided, the script will ask for input')
 parser.add_argument('-f', '--fileNameCSV', help='the CSV file of name changes. optional - if not provided, the script will ask for input')
 parser.add_argument('-m', '--makeChanges', help='Enter "true" to if the script should actually rename the files (otherwise, it will only create a log of the expected file name changes). optional - if not provided, the script will to "false"')
+parser.add_argument('-l', '--logFormat', choices=LOG_FORMATS, default='csv', help='the format of the log of file name changes: binary is compact and indexed, for confirmFileNameChanges to read memory-mapped. optional - default csv')
+parser.add_argument('-z', '--logCompression', choices=LOG_COMPRESSIONS, default='none', help='the compression of the log (zstd needs the zstandard package). optional - default none')
 args = parser.parse_args()
 
 if args.directory:
@@ -28,28 +32,46 @@ directoryName = directoryName.replace(':', '')
 print directoryName
 
 startTime = time.time()
-f=csv.writer(open('renameLog'+directoryName+datetime.now().strftime('%Y-%m-%d %H.%M.%S')+'.csv','wb'))
-f.writerow(['oldFileName']+['newFileName'])
-for filePath, subFolders, fileNames in os.walk(directory, topdown=True):
-    for fileName in fileNames:
-        with open(fileNameCSV) as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                oldFileName = row['fileName']
-                newFileName = row['newFileName']
-                currentFolderName = row['currentFilePath']
-                if fileName == oldFileName and filePath == currentFolderName:
-                    oldPath = os.path.join(filePath,fileName)
-                    newPath = os.path.join(filePath,newFileName)
-                    print 'anticipated changes: '+oldPath+', '+newPath
-                    f.writerow([oldPath]+[newPath])
-                    if makeChanges == 'true':
-                        if os.path.exists(newPath):
-                            print "Error renaming '%s' to '%s': destination file already exists." % (oldPath, newPath)
-                        else:
-                            os.rename(oldPath,newPath)
-                    else:
-                        print 'log of expected file name changes created only, no files renamed'
+# index the CSV once by (currentFilePath, fileName), so that each file found is a single lookup
+newFileNames = {}
+with open(fileNameCSV) as csvfile:
+    reader = csv.DictReader(csvfile)
+    for row in reader:
+        key = (row['currentFilePath'], row['fileName'])
+        if key in newFileNames:
+            print "Ignoring duplicate entry for '%s' in '%s'" % (key[1], key[0])
+        else:
+            newFileNames[key] = row['newFileName']
+matchedKeys = set()
+
+# the log is written as the files are found, through a large buffer
+logFileName = log_filename('renameLog'+directoryName+datetime.now().strftime('%Y-%m-%d %H.%M.%S'), args.logFormat, args.logCompression)
+with RenameLogWriter(logFileName, ['oldFileName', 'newFileName'], format=args.logFormat, compression=args.logCompression) as f:
+    for item in walk_dir(directory, absolute=False):
+        if item.type == 'dir':
+            # the walker lists each directory's files right after it, so this is the files' folder name
+            filePath = item.path
+            continue
+        fileName = os.path.basename(item.path)
+        newFileName = newFileNames.get((filePath, fileName))
+        if newFileName is not None:
+            matchedKeys.add((filePath, fileName))
+            oldPath = item.path
+            newPath = os.path.join(filePath,newFileName)
+            print 'anticipated changes: '+oldPath+', '+newPath
+            f.writerow([oldPath, newPath])
+            if makeChanges == 'true':
+                if os.path.exists(newPath):
+                    print "Error renaming '%s' to '%s': destination file already exists." % (oldPath, newPath)
+                else:
+                    os.rename(oldPath,newPath)
+            else:
+                print 'log of expected file name changes created only, no files renamed'
+
+unmatchedKeys = sorted(set(newFileNames) - matchedKeys)
+print '%d of %d CSV rows did not match a file' % (len(unmatchedKeys), len(newFileNames))
+for currentFolderName, oldFileName in unmatchedKeys:
+    print 'no file found for: '+os.path.join(currentFolderName, oldFileName)
 
 elapsedTime = time.time() - startTime
 m, s = divmod(elapsedTime, 60)
@@ -4,11 +4,46 @@
 from __future__ import print_function, unicode_literals
 
 import argparse
-from bag_updater import Bag
+from bag_state import BagState
+from bag_updater import VALIDATION_LEVELS, BagView, ManifestCache
+from bulk_rename import BulkRenamer
+from bounded_update import decoded_renames, sort_renames, update_payload_filenames_sorted, validate_sorted
+import collections
 from collections import OrderedDict
-import csv
 from datetime import datetime
+from external_sort import DEFAULT_RUN_SIZE
+from fixity_cache import FixityCache
+from fs_executor import FsExecutor
+from instrumentation import Metrics, print_progress
+import io
+import itertools
+import json
+import multiprocessing
 import os
+from rename_journal import DEFAULT_BATCH_SIZE, RenameJournal, RenameJournalError
+from rename_log import LOG_COMPRESSIONS, LOG_FORMATS, RenameLogError, RenameLogWriter, check_compression, log_filename
+from rename_rules import RenameRuleError, RenameRules
+import sys
+import time
+import traceback
+try:
+    from StringIO import StringIO  # Python 2: accepts both str and unicode
+except ImportError:
+    from io import StringIO
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# directory snapshots kept by the renamer in bounded-memory mode
+BOUNDED_SNAPSHOTS = 1024
+# files to which the rename rules are applied at a time
+RULE_BATCH_SIZE = 10000
+# the columns of rename maps, as of renameFilesInMultipleDirectories' logs
+RENAME_MAP_COLUMNS = ['oldFileName', 'newFileName']
+
+BagResult = collections.namedtuple('BagResult', ['index', 'bag_dir', 'success', 'elapsed', 'output', 'error',
+                                                 'metrics', 'skipped'])
 
 
 def main():
@@ -18,99 +53,520 @@ def main():
     parser.add_argument('-m', '--map', dest='map', action='store_true',
                         help="output the mapping from old filename to new filename")
     parser.add_argument('--map-file', dest='map_file', help='file to receive mapping from old filename to new filename')
+    parser.add_argument('--map-format', dest='map_format', choices=LOG_FORMATS, default='csv',
+                        help="format of the rename map: 'binary' is compact and indexed, for confirmFileNameChanges "
+                             "to read memory-mapped (default: %(default)s)")
+    parser.add_argument('--map-compression', dest='map_compression', choices=LOG_COMPRESSIONS, default='none',
+                        help="compression of the rename map; 'zstd' needs the zstandard package (default: "
+                             "%(default)s)")
+    parser.add_argument('--rules', dest='rules',
+                        help='JSON file of the rules for the new names of the payload files (default: the JHU '
+                             'rules, rename_rules.DEFAULT_RULES)')
     parser.add_argument('--processes', dest='processes', type=int, default=1,
                         help='Use multiple processes to calculate checksums faster (default: %(default)s)')
+    parser.add_argument('--manifest-processes', dest='manifest_processes', type=int, default=1,
+                        help='Use multiple processes to rewrite the payload manifests (one per algorithm) '
+                             'concurrently (default: %(default)s)')
+    parser.add_argument('--pre-validate', dest='pre_validate', choices=VALIDATION_LEVELS, default='full',
+                        help="'full' validates all payload checksums before the update; 'structure' checks the "
+                             "bag's structure, Payload-Oxum, that its payload files are those in its manifests and "
+                             "its tag manifests, without reading the payload; 'oxum' only its structure and "
+                             "Payload-Oxum; 'none' nothing (default: %(default)s)")
+    parser.add_argument('--post-validate', dest='post_validate', choices=['full', 'rename'], default='full',
+                        help="'full' re-validates all payload checksums after the update; 'rename' only verifies "
+                             "that the renamed files, manifests and tag manifests are consistent, without "
+                             "re-reading the payload (default: %(default)s)")
+    parser.add_argument('--fixity-cache', dest='fixity_cache',
+                        help='SQLite file in which to cache payload checksums between runs, keyed by device, inode, '
+                             'size and mtime; may be shared by several bags')
+    parser.add_argument('--fresh-fixity', dest='fresh_fixity', action='store_true',
+                        help='re-calculate all checksums, ignoring (but refreshing) the fixity cache, e.g. for a '
+                             'real fixity audit')
+    parser.add_argument('--recover', dest='recover', choices=['forward', 'back'],
+                        help='complete (forward) or undo (back) the update of a bag that was interrupted, as '
+                             'recorded in its rename journal')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help="skip bags whose tag manifests and rename rules are unchanged since their last "
+                             "successful run, as recorded in a state file (.<bag>.rename-state) in each bag's parent "
+                             "directory, and roll forward (unless --recover says otherwise) bags whose last run was "
+                             "interrupted, so that only their remaining renames are made")
+    parser.add_argument('--journal-batch-size', dest='journal_batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='number of renames to journal (and fsync) at a time (default: %(default)s)')
+    parser.add_argument('--fs-threads', dest='fs_threads', type=int, default=1,
+                        help='directory listings and renames to have in flight at once, from a pool of threads, for '
+                             'high-latency (network) filesystems (default: %(default)s, one at a time)')
+    parser.add_argument('--bag-workers', dest='bag_workers', type=int, default=1,
+                        help='number of bags to process concurrently, each in its own process (default: %(default)s)')
+    parser.add_argument('--bags-per-volume', dest='bags_per_volume', type=int,
+                        help='with --bag-workers, the most bags to process concurrently on any one volume '
+                             '(default: no limit)')
+    parser.add_argument('--bounded-memory', dest='bounded_memory', action='store_true',
+                        help='keep memory use constant however many payload files a bag has, by external sorts of '
+                             'the rename plan, manifest entries and payload file list (spilled to --tmp-dir) and '
+                             "merge-joins of them, rather than loading the bag; --post-validate rename then checks "
+                             "the manifests' completeness and the tag manifests")
+    parser.add_argument('--sort-run-size', dest='sort_run_size', type=int, default=DEFAULT_RUN_SIZE,
+                        help='with --bounded-memory, the records sorted in memory at a time (default: %(default)s)')
+    parser.add_argument('--tmp-dir', dest='tmp_dir',
+                        help='with --bounded-memory, the directory for the sorts\' temporary files (default: the '
+                             'system temporary directory)')
+    parser.add_argument('--metrics-json', dest='metrics_json',
+                        help="file to receive each bag's phase times and counters (files renamed, bytes hashed, "
+                             "manifest lines rewritten...) as JSON")
+    parser.add_argument('--progress-interval', dest='progress_interval', type=float, default=60,
+                        help='seconds between progress reports (rate and ETA) on stderr during long phases; '
+                             '0 for none (default: %(default)s)')
+    parser.add_argument('--profile-dir', dest='profile_dir',
+                        help='directory to receive a cProfile stats file of each phase of each bag, as '
+                             '<bag>.<phase>.prof (worker processes are not profiled)')
     parser.add_argument('directories', nargs='+', help='one or more BagIt directories')
     args = parser.parse_args()
+    if args.rules is not None:
+        # fail before any bag on rules that can't be read or compiled
+        try:
+            RenameRules.from_file(args.rules).for_bag('')
+        except (IOError, OSError, RenameRuleError) as e:
+            parser.error(str(e))
+    try:
+        check_compression(args.map_compression)
+    except RenameLogError as e:
+        parser.error(str(e))
+
+    if args.bag_workers > 1:
+        results = process_bags_concurrently(args)
+    else:
+        results = [process_bag(index, bag_dir, args, out=sys.stdout) for index, bag_dir in enumerate(args.directories)]
+    print_summary(results)
+    if args.metrics_json is not None:
+        write_metrics(results, args.metrics_json)
+    return 0 if all(result.success for result in results) else 1
+
+
+def process_bag(index, bag_dir, args, out=None):
+    """rename the payload of the bag in bag_dir and update its manifests, reporting progress to out
+
+    Errors are reported in the returned BagResult rather than raised. If out is None, the bag's output
+    is collected in the BagResult instead.
+    """
+    collected = out is None
+    if collected:
+        out = StringIO()
+    start_time = time.time()
+    fixity_cache = None
+    bag_name = os.path.basename(os.path.abspath(bag_dir))
+    metrics = Metrics(progress_callbacks=[print_progress(prefix='%s: ' % bag_name)] if args.progress_interval else [],
+                      progress_interval=args.progress_interval, profile_dir=args.profile_dir,
+                      profile_prefix='%s.' % bag_name)
+    skipped = False
+    try:
+        print("*** Starting processing of bag in directory '%s'" % bag_dir, file=out)
+        state = rules_digest = None
+        if args.incremental:
+            state = BagState.for_bag(bag_dir)
+            rules_digest = load_rules(args).digest()
+            # a bag with a journal was interrupted, whatever its state says
+            recorded = state.current(bag_dir, rules_digest) if not RenameJournal.for_bag(bag_dir).exists() else None
+            skipped = recorded is not None
+        if skipped:
+            print("Bag unchanged since its last run, finished %s (%d files renamed); skipping."
+                  % (recorded['finished'], recorded['renamed']), file=out)
+        else:
+            if args.fixity_cache is not None:
+                fixity_cache = FixityCache(args.fixity_cache, trust=not args.fresh_fixity)
+            # the bag's parsed manifests are only worth keeping while it's being processed
+            renamed = update_bag(bag_dir, args, fixity_cache=fixity_cache, metrics=metrics,
+                                 manifest_cache=ManifestCache(), out=out)
+            if state is not None and renamed is not None:
+                state.save(bag_dir, rules_digest, renamed)
+        print("... Completed processing of bag in directory '%s'" % bag_dir, file=out)
+        error = None
+    except Exception as e:
+        print('', file=out)
+        traceback.print_exc(file=out)
+        print("... Failed processing of bag in directory '%s'" % bag_dir, file=out)
+        error = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        if fixity_cache is not None:
+            fixity_cache.close()
+    return BagResult(index=index, bag_dir=bag_dir, success=error is None, elapsed=time.time() - start_time,
+                     output=out.getvalue() if collected else '', error=error, metrics=metrics.as_dict(),
+                     skipped=skipped)
 
+
+def update_bag(bag_dir, args, fixity_cache=None, metrics=None, manifest_cache=None, out=sys.stdout):
+    """rename the bag's payload and update its manifests, returning the number of files renamed, or None if the
+    run was a dry run or a recovery
+    """
     processes = args.processes
+    if metrics is None:
+        metrics = Metrics()
+    if args.bounded_memory:
+        return update_bag_bounded(bag_dir, args, fixity_cache=fixity_cache, metrics=metrics,
+                                  manifest_cache=manifest_cache, out=out)
+    # planning only needs the payload files, so the manifests are only loaded if the bag is to be validated
+    with metrics.phase('open'):
+        view = BagView(bag_dir, manifest_cache=manifest_cache)
+    bag_name = os.path.basename(view.path)
 
-    for bag_dir in args.directories:
-        print("*** Starting processing of bag in directory '%s'" % bag_dir)
-        bag = Bag(bag_dir)
-        bag_name = os.path.basename(bag.path)
-
-        # our renamer is a generator
-        payload_files = sorted(bag.payload_files())
-        rename_map = OrderedDict((old, new) for old, new in rename_files(payload_files, basedir=bag.path))
-        rename_count = len(rename_map)
-        # if no entries in rename_map, then we are not remapping, so won't need to perform validation
-        remapping = (rename_count > 0)
-
-        if args.map or args.map_file is not None:
-            if args.map_file is not None:
-                map_file = args.map_file
-            else:
-                map_file = 'renameLog-' + bag_name + '-' + datetime.now().strftime('%Y%m%dT%H%M%S') + '.csv'
-            print("Printing rename map to file '%s'" % map_file)
-            emit_rename_map(rename_map, filename=map_file, type='csv')
+    journal = RenameJournal.for_bag(view.path)
+    if journal.exists():
+        with metrics.phase('open'):
+            bag = view.open_bag(fixity_cache=fixity_cache, metrics=metrics)
+        recover_bag(bag, journal, args, out=out)
+        if not resumes_after_recovery(args):
+            print_phase_times(metrics, out=out)
+            return None
+        # the files the interrupted run didn't get to are renamed now
+        view = view.refresh()
 
-        if not remapping:
-            print("No files to rename. No updates or bag validations will be performed.")
-        elif not args.dry_run:
-            # run pre-update validation to ensure that bag is okay before we start
-            print("Pre-update validation of bag '%s'..." % bag_name, end='')
-            bag.validate(processes=processes,)
-            print('finished.')
-
-            print('Renaming %d files in the filesystem...' % rename_count, end='')
-            success = all([fs_rename(old, new, basedir=bag.path, dry_run=False) for old, new in rename_map.items()])
-            print('finished.')
-            print("Updating bag '%s' payload and tag manifests..." % bag_name, end='')
-            bag.update_payload_filenames(rename_map=rename_map)
-            print('finished.')
+    # planning and renaming share the renamer's one listing of each directory
+    renamer = BulkRenamer(view.path)
+    # the map is written as the renames are planned
+    rename_log = open_rename_map(args, bag_name, out=out)
+    try:
+        # the threads are only kept for the phases that use them, not across the pre-validation's forks
+        with metrics.phase('plan'), FsExecutor(args.fs_threads) as executor:
+            # our renamer is a generator
+            payload_files = sorted(view.payload_files(executor=executor))
+            renamer.prefetch(sorted(set(os.path.dirname(filepath) for filepath in payload_files)), executor=executor)
+            rename_map = OrderedDict(rename_files(payload_files, basedir=view.path, rules=load_rules(args), out=out,
+                                                  renamer=renamer, log=rename_log))
+    finally:
+        if rename_log is not None:
+            rename_log.close()
+    rename_count = len(rename_map)
+    # if no entries in rename_map, then we are not remapping, so won't need to perform validation
+    remapping = (rename_count > 0)
+
+    if not remapping:
+        print("No files to rename. No updates or bag validations will be performed.", file=out)
+    elif not args.dry_run:
+        with metrics.phase('open'):
+            bag = view.open_bag(fixity_cache=fixity_cache, metrics=metrics)
+
+        # run pre-update validation to ensure that bag is okay before we start
+        if args.pre_validate != 'none':
+            print("Pre-update validation (%s) of bag '%s'..." % (args.pre_validate, bag_name), end='', file=out)
+            with metrics.phase('pre-validate'):
+                bag.validate_level(args.pre_validate, processes=processes)
+            print('finished.', file=out)
+
+        if args.post_validate == 'rename':
+            # the payload files' sizes and mtimes before the renames, for the post-update rename verification
+            with metrics.phase('snapshot'):
+                payload_stats = bag.payload_file_stats(rename_map.keys())
 
+        def update_manifests(on_manifest_rewritten):
+            bag.update_payload_filenames(rename_map=rename_map, processes=args.manifest_processes,
+                                         on_manifest_rewritten=on_manifest_rewritten)
+        rename_journalled(journal, bag.path, rename_map, rename_count, renamer, update_manifests, args, metrics,
+                          out=out)
+
+        if args.post_validate == 'rename':
+            # checked against the manifests loaded before the update, so don't refresh the bag
+            print("Post-update rename verification of bag '%s'..." % bag_name, end='', file=out)
+            with metrics.phase('post-validate'):
+                bag.validate_renamed(rename_map, payload_stats)
+            print('finished.', file=out)
+        else:
             # re-open and validate the update bag
-            bag = bag.refresh()
-            print("Post-update validation of bag '%s'..." % bag_name, end='')
-            bag.validate(processes=processes, )
-            print('finished.')
+            with metrics.phase('post-validate'):
+                bag = bag.refresh()
+                print("Post-update validation of bag '%s'..." % bag_name, end='', file=out)
+                bag.validate(processes=processes, )
+            print('finished.', file=out)
+    print_phase_times(metrics, out=out)
+    return rename_count if not args.dry_run else None
+
 
-        print("... Completed processing of bag in directory '%s'" % bag_dir)
+def update_bag_bounded(bag_dir, args, fixity_cache=None, metrics=None, manifest_cache=None, out=sys.stdout):
+    """as update_bag, but in bounded memory, using bounded_update rather than opening the bag"""
+    if metrics is None:
+        metrics = Metrics()
+    bag_path = os.path.abspath(bag_dir)
+    bag_name = os.path.basename(bag_path)
+    with metrics.phase('open'):
+        view = BagView(bag_path, manifest_cache=manifest_cache)
+    encoding = view.encoding
 
+    journal = RenameJournal.for_bag(bag_path)
+    if journal.exists():
+        # recovery replays the journal in memory, so open the bag for it as usual
+        with metrics.phase('open'):
+            bag = view.open_bag(fixity_cache=fixity_cache, metrics=metrics)
+        recover_bag(bag, journal, args, out=out)
+        if not resumes_after_recovery(args):
+            print_phase_times(metrics, out=out)
+            return None
+        # the files the interrupted run didn't get to are renamed now
+        view = view.refresh()
 
+    sort_options = dict(run_size=args.sort_run_size, tmp_dir=args.tmp_dir)
+    # the payload is walked a directory at a time, so only the snapshots of the last few directories are needed
+    renamer = BulkRenamer(bag_path, max_snapshots=BOUNDED_SNAPSHOTS)
+    # the map is written as the renames are planned, in the order they're walked rather than sorted
+    rename_log = open_rename_map(args, bag_name, out=out)
+    try:
+        with metrics.phase('plan'), FsExecutor(args.fs_threads) as executor:
+            sorted_renames = sort_renames(rename_files(view.payload_files(executor=executor), basedir=bag_path,
+                                                       rules=load_rules(args), out=out, renamer=renamer,
+                                                       log=rename_log),
+                                          encoding=encoding, **sort_options)
+    finally:
+        if rename_log is not None:
+            rename_log.close()
+    try:
+        rename_count = len(sorted_renames)
+        if rename_count == 0:
+            print("No files to rename. No updates or bag validations will be performed.", file=out)
+        elif not args.dry_run:
+            if args.pre_validate != 'none':
+                print("Pre-update validation (%s) of bag '%s'..." % (args.pre_validate, bag_name), end='', file=out)
+                with metrics.phase('pre-validate'):
+                    view.validate_oxum()
+                    if args.pre_validate != 'oxum':
+                        validate_sorted(bag_path, encoding=encoding, hash_payload=args.pre_validate == 'full',
+                                        processes=args.processes, fixity_cache=fixity_cache, metrics=metrics,
+                                        **sort_options)
+                print('finished.', file=out)
 
-def emit_rename_map(rename_map, filename=None, type='csv'):
-    f = csv.writer(open(filename, 'wb'))
-    with open(filename, 'wb') as f:
-        writer = csv.writer(f)
-        for old, new in rename_map.items():
-            writer.writerow([old, new])
+            def update_manifests(on_manifest_rewritten):
+                update_payload_filenames_sorted(bag_path, sorted_renames, encoding=encoding,
+                                                processes=args.manifest_processes,
+                                                on_manifest_rewritten=on_manifest_rewritten, metrics=metrics,
+                                                **sort_options)
+            rename_journalled(journal, bag_path, decoded_renames(sorted_renames, encoding), rename_count, renamer,
+                              update_manifests, args, metrics, out=out)
 
+            if args.post_validate == 'rename':
+                print("Post-update completeness and tag manifest check of bag '%s'..." % bag_name, end='', file=out)
+            else:
+                print("Post-update validation of bag '%s'..." % bag_name, end='', file=out)
+            with metrics.phase('post-validate'):
+                validate_sorted(bag_path, encoding=encoding, hash_payload=args.post_validate == 'full',
+                                processes=args.processes, fixity_cache=fixity_cache, metrics=metrics, **sort_options)
+            print('finished.', file=out)
+    finally:
+        sorted_renames.close()
+    print_phase_times(metrics, out=out)
+    return rename_count if not args.dry_run else None
 
-def rename_files(files_to_rename, basedir='', institution='jhu', interfield_sep='_', intrafield_sep='-'):
-    previously = successes = failures = 0
-    collection = intrafield_sep.join(os.path.basename(basedir).split(intrafield_sep)[0:2])
-    for filepath in files_to_rename:
-        if os.path.basename(filepath).startswith(institution + interfield_sep):
-            previously += 1
+
+def rename_journalled(journal, bag_path, renames, rename_count, renamer, update_manifests, args, metrics,
+                      out=sys.stdout):
+    """rename the bag's payload files as in renames, the rename_count (old, new) pairs planned by the renamer,
+    then update its manifests with update_manifests(on_manifest_rewritten), all recorded in the journal so that
+    an interrupted update can be recovered with --recover
+    """
+    bag_name = os.path.basename(bag_path)
+    with journal:
+        journal.begin(bag_path)
+        print('Renaming %d files in the filesystem...' % rename_count, end='', file=out)
+        with metrics.phase('rename'), renamer, FsExecutor(args.fs_threads) as executor:
+            progress = metrics.progress('files_renamed', total=rename_count)
+
+            def rename(renames):
+                renamed = renamer.rename_many(renames, executor=executor)
+                progress.update(len(renames))
+                return renamed
+            journal.rename_all(renames, rename, batch_size=args.journal_batch_size, batched=True)
+        print('finished.', file=out)
+        print("Updating bag '%s' payload and tag manifests..." % bag_name, end='', file=out)
+        with metrics.phase('manifest-rewrite'):
+            update_manifests(journal.record_manifest)
+            journal.finish()
+        print('finished.', file=out)
+
+
+def open_rename_map(args, bag_name, out=sys.stdout):
+    """the rename_log.RenameLogWriter of the bag's rename map, if args ask for one, otherwise None"""
+    if not args.map and args.map_file is None:
+        return None
+    if args.map_file is not None:
+        map_file = args.map_file
+    else:
+        map_file = log_filename('renameLog-' + bag_name + '-' + datetime.now().strftime('%Y%m%dT%H%M%S'),
+                                format=args.map_format, compression=args.map_compression)
+    print("Printing rename map to file '%s'" % map_file, file=out)
+    return RenameLogWriter(map_file, RENAME_MAP_COLUMNS, format=args.map_format, compression=args.map_compression)
+
+
+def resumes_after_recovery(args):
+    """whether an incremental run goes on to rename the rest of the files of a bag it's rolled forward"""
+    return args.incremental and args.recover is None and not args.dry_run
+
+
+def recover_bag(bag, journal, args, out=sys.stdout):
+    """roll the interrupted update of the bag forward or back, as args.recover says (or, with args.incremental,
+    forward by default), from its rename journal
+    """
+    bag_name = os.path.basename(bag.path)
+    direction = args.recover
+    if direction is None and args.incremental:
+        direction = 'forward'
+    if direction is None:
+        raise RenameJournalError("Bag '%s' has the rename journal '%s' of an interrupted update; use --recover "
+                                 "forward or --recover back to complete or undo it" % (bag_name, journal.path))
+    if args.dry_run:
+        print("Would roll %s the interrupted update of bag '%s'" % (direction, bag_name), file=out)
+        return
+    print("Rolling %s the interrupted update of bag '%s'..." % (direction, bag_name), end='', file=out)
+    with journal, bag.metrics.phase('recover'):
+        if direction == 'forward':
+            state = journal.roll_forward(bag, processes=args.manifest_processes)
         else:
-            dir_tree = filepath.split(os.sep)
-            new_basename = interfield_sep.join([institution, collection, intrafield_sep.join(dir_tree[-2:])])
-            dir_tree[-1] = new_basename
-            new_filepath = os.sep.join(dir_tree)
-            # print("- renaming '%s' to '%s'..." % (filepath, new_filepath), end='')
-            if fs_rename(filepath, new_filepath, basedir=basedir, dry_run=True):
+            state = journal.roll_back(bag, processes=args.manifest_processes)
+    print('finished (%d renames, %d pending).' % (len(state.rename_map), len(state.pending)), file=out)
+
+    # recovery doesn't touch the payload's contents, so check that the manifests and files agree without hashing
+    print("Post-recovery completeness check of bag '%s'..." % bag_name, end='', file=out)
+    with bag.metrics.phase('post-validate'):
+        bag.refresh().validate(completeness_only=True)
+    print('finished.', file=out)
+
+
+def process_bags_concurrently(args, out=sys.stdout):
+    """process_bag() each of args.directories in its own process, up to args.bag_workers at a time and
+    up to args.bags_per_volume at a time on any one volume (device), printing each bag's output as it
+    completes
+    """
+    # bags waiting to start, by volume, in argument order
+    waiting = OrderedDict()
+    for index, bag_dir in enumerate(args.directories):
+        try:
+            volume = os.stat(bag_dir).st_dev
+        except OSError:
+            volume = None  # let processing of the bag report the problem
+        waiting.setdefault(volume, collections.deque()).append((index, bag_dir))
+
+    result_queue = multiprocessing.Queue()
+    running = {}  # index -> (process, volume, bag_dir)
+    volume_load = collections.Counter()
+    results = []
+    while waiting or running:
+        # start bags a volume at a time, to spread the load across volumes
+        started = True
+        while started and len(running) < args.bag_workers:
+            started = False
+            for volume in list(waiting):
+                if len(running) >= args.bag_workers:
+                    break
+                if args.bags_per_volume is not None and volume_load[volume] >= args.bags_per_volume:
+                    continue
+                index, bag_dir = waiting[volume].popleft()
+                if not waiting[volume]:
+                    del waiting[volume]
+                # a plain (non-daemonic) Process, since bag validation may itself use a multiprocessing pool
+                process = multiprocessing.Process(target=_process_bag_worker,
+                                                  args=(index, bag_dir, args, result_queue))
+                process.start()
+                running[index] = (process, volume, bag_dir)
+                volume_load[volume] += 1
+                started = True
+
+        try:
+            finished = [result_queue.get(timeout=1)]
+        except queue.Empty:
+            # a worker that exits without error will have queued its result; report any that died
+            finished = [BagResult(index=index, bag_dir=bag_dir, success=False, elapsed=0, output='',
+                                  error='worker process exited with code %s' % process.exitcode, metrics=None,
+                                  skipped=False)
+                        for index, (process, volume, bag_dir) in running.items()
+                        if not process.is_alive() and process.exitcode != 0]
+        for result in finished:
+            process, volume, bag_dir = running.pop(result.index)
+            process.join()
+            volume_load[volume] -= 1
+            out.write(result.output)
+            if result.error is not None and not result.output:
+                print("... Failed processing of bag in directory '%s': %s" % (bag_dir, result.error), file=out)
+            out.flush()
+            results.append(result)
+    return sorted(results, key=lambda result: result.index)
+
+
+def _process_bag_worker(index, bag_dir, args, result_queue):
+    result_queue.put(process_bag(index, bag_dir, args))
+
+
+def print_summary(results, out=sys.stdout):
+    rows = [(result.bag_dir, ('skipped' if result.skipped else 'success') if result.success else 'FAILURE',
+             '%.1fs' % result.elapsed, result.error or '') for result in results]
+    headings = ('Bag', 'Result', 'Time', 'Error')
+    widths = [max(len(row[column]) for row in rows + [headings]) for column in range(3)]
+    row_format = '%%-%ds  %%-%ds  %%%ds  %%s' % tuple(widths)
+    print('', file=out)
+    print((row_format % headings).rstrip(), file=out)
+    for row in rows:
+        print((row_format % row).rstrip(), file=out)
+    skipped = sum(result.skipped for result in results)
+    print('%d of %d bags processed successfully%s' % (sum(result.success for result in results), len(results),
+                                                      ' (%d skipped as unchanged)' % skipped if skipped else ''),
+          file=out)
+
+
+def print_phase_times(metrics, out=sys.stdout):
+    print('Phase times: %s' % ', '.join('%s %.1fs' % (name, seconds) for name, seconds in metrics.phases.items()),
+          file=out)
+
+
+def write_metrics(results, filename):
+    """write the metrics of each bag's BagResult to filename as JSON"""
+    bags = [OrderedDict([('bag', result.bag_dir), ('success', result.success), ('skipped', result.skipped),
+                         ('elapsed', round(result.elapsed, 4)), ('error', result.error)] +
+                        list((result.metrics or {}).items()))
+            for result in results]
+    with io.open(filename, 'w', encoding='utf-8') as f:
+        # io text files only take unicode, which json.dumps doesn't always return under Python 2
+        f.write('%s\n' % json.dumps(bags, indent=2))
+
+
+def emit_rename_map(rename_map, filename=None, type='csv', compression='none'):
+    with RenameLogWriter(filename, RENAME_MAP_COLUMNS, format=type, compression=compression) as writer:
+        writer.writerows(rename_map.items() if hasattr(rename_map, 'items') else rename_map)
+
+
+def load_rules(args):
+    return RenameRules.from_file(args.rules) if args.rules is not None else RenameRules()
+
+
+def rename_files(files_to_rename, basedir='', rules=None, out=None, renamer=None, batch_size=RULE_BATCH_SIZE,
+                 log=None):
+    """plan the renames of files_to_rename (relative to basedir, a bag) by the rename_rules.RenameRules (by default
+    the JHU rules), yielding (old, new) for each rename that can be made, and writing it to the log (a
+    rename_log.RenameLogWriter) if any, and reporting those that can't to out. The rules are applied to
+    batch_size files at a time, and the batch's renames then checked together by the renamer (by default a
+    bulk_rename.BulkRenamer of basedir)
+    """
+    if out is None:
+        out = sys.stdout
+    if renamer is None:
+        renamer = BulkRenamer(basedir)
+    if rules is None:
+        rules = RenameRules()
+    compiled_rules = rules.for_bag(os.path.basename(basedir))
+    previously = successes = failures = 0
+    files_to_rename = iter(files_to_rename)
+    while True:
+        planned = compiled_rules.apply(itertools.islice(files_to_rename, batch_size))
+        if not planned:
+            break
+        for filepath, new_filepath in planned:
+            if new_filepath is None:
+                previously += 1
+            elif renamer.plan(filepath, new_filepath):
                 successes += 1
-                # print('success.')
+                if log is not None:
+                    log.writerow((filepath, new_filepath))
                 # yield the old and new path only on success
                 yield filepath, new_filepath
             else:
                 failures += 1
-                # print('failure.')
+                conflict = renamer.conflicts[-1]
+                print("Cannot rename '%s' to '%s': %s" % conflict, file=out)
     print('Renaming plan summary: To be renamed: %d; Cannot rename: %d; Previously renamed: %d'
-          % (successes, failures, previously))
-
-
-def fs_rename(old, new, basedir='', dry_run=True):
-    old = os.path.join(basedir, old)
-    new = os.path.join(basedir, new)
-    if old != new and os.path.exists(old) and not os.path.exists(new):
-        if not dry_run:
-            os.rename(old, new)
-        return True
-    return False
+          % (successes, failures, previously), file=out)
 
 
 if __name__=='__main__':
-    main()
+    sys.exit(main())
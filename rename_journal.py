@@ -0,0 +1,225 @@
+from __future__ import print_function, unicode_literals
+
+import collections
+from datetime import datetime
+import itertools
+import json
+import logging
+import os
+from safe_overwrite import fsync_dir, recover_overwrites
+
+LOGGER = logging.getLogger(__name__)
+
+# how many renames are recorded, and fsync'd, ahead of being made
+DEFAULT_BATCH_SIZE = 1000
+
+JournalState = collections.namedtuple('JournalState', ['bag', 'rename_map', 'pending', 'renamed',
+                                                       'rewritten_manifests', 'rolling_back'])
+
+
+class RenameJournalError(Exception):
+    pass
+
+
+class RenameJournal(object):
+    """Write-ahead journal of the renames in a bag and of the rewriting of its manifests.
+
+    The journal is a file of JSON records, one per line, in the bag's parent directory (so that it isn't
+    part of the bag). Renames are recorded in batches that are fsync'd before any of their renames are
+    made, and each batch is marked done once it has been made. After the renames, each rewritten payload
+    manifest is recorded, once the transaction (safe_overwrite.OverwriteTransaction) rewriting them has committed. The journal is removed when the update is complete, so a journal that exists
+    belongs to an interrupted run, which roll_forward() or roll_back() can recover without re-hashing.
+
+    Records:
+        ["begin", bag path, timestamp]
+        ["rename", batch, old, new]     (relative to the bag)
+        ["batch", batch]                (the batch is complete and synced; its renames may be under way)
+        ["done", batch]                 (the batch's renames have all been made)
+        ["renamed"]                     (all renames have been made; manifests may be under way)
+        ["manifest", relpath]           (the payload manifest has been rewritten)
+        ["rollback"]                    (a roll back has started)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    @classmethod
+    def for_bag(cls, bag_path):
+        bag_path = os.path.abspath(bag_path)
+        parent, bag_name = os.path.split(bag_path)
+        return cls(os.path.join(parent, '.%s.rename-journal' % bag_name))
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def begin(self, bag_path):
+        if self.exists():
+            raise RenameJournalError("Journal of an interrupted run already exists: '%s'" % self.path)
+        self._open()
+        self._write(['begin', os.path.abspath(bag_path), datetime.now().isoformat()], sync=True)
+        # make the journal's existence durable too
+        fsync_dir(os.path.dirname(self.path))
+
+    def rename_all(self, rename_map, rename, batch_size=DEFAULT_BATCH_SIZE, batched=False):
+        """make the renames of rename_map (old to new, relative to the bag, as a mapping or an iterable of
+        pairs) with rename(old, new), journalling them in batches. rename() returns whether the rename
+        succeeded; if any fail, RenameJournalError is raised after their batch, leaving the journal for recovery.
+        With batched, rename(renames) is given each batch's list of renames, to make at once, and returns whether
+        each succeeded
+        """
+        items = iter(rename_map.items() if hasattr(rename_map, 'items') else rename_map)
+        for batch in itertools.count():
+            renames = list(itertools.islice(items, batch_size))
+            if not renames:
+                break
+            self._write_all([['rename', batch, old, new] for old, new in renames] + [['batch', batch]], sync=True)
+            renamed = rename(renames) if batched else [rename(old, new) for old, new in renames]
+            failures = [pair for pair, success in zip(renames, renamed) if not success]
+            if failures:
+                raise RenameJournalError('Could not rename %d files, first %s to %s; recover with roll back'
+                                         % ((len(failures),) + failures[0]))
+            self._write(['done', batch])
+        self._write(['renamed'], sync=True)
+
+    def record_manifest(self, relpath):
+        self._write(['manifest', relpath], sync=True)
+
+    def finish(self):
+        """the update is complete: remove the journal"""
+        self.close()
+        os.remove(self.path)
+        fsync_dir(os.path.dirname(self.path))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def load(self):
+        """the JournalState recorded by an interrupted run"""
+        bag = None
+        rename_map = collections.OrderedDict()
+        batches = collections.OrderedDict()
+        done = set()
+        renamed = rolling_back = False
+        rewritten_manifests = set()
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # a torn last record, from a crash while writing it, wasn't synced so was never acted on
+                    break
+                kind = record[0]
+                if kind == 'begin':
+                    bag = record[1]
+                elif kind == 'rename':
+                    batches.setdefault(record[1], []).append((record[2], record[3]))
+                elif kind == 'batch':
+                    rename_map.update(batches[record[1]])
+                elif kind == 'done':
+                    done.add(record[1])
+                elif kind == 'renamed':
+                    renamed = True
+                elif kind == 'manifest':
+                    rewritten_manifests.add(record[1])
+                elif kind == 'rollback':
+                    rolling_back = True
+        # renames of a batch that wasn't completely recorded were never started
+        pending = [(old, new) for batch, renames in batches.items() if batch not in done for old, new in renames
+                   if rename_map.get(old) == new]
+        return JournalState(bag=bag, rename_map=rename_map, pending=pending, renamed=renamed,
+                            rewritten_manifests=rewritten_manifests, rolling_back=rolling_back)
+
+    def roll_forward(self, bag, processes=1):
+        """complete the interrupted update of the bag (a bag_updater.Bag)"""
+        state = self._load_for(bag)
+        if state.rolling_back:
+            raise RenameJournalError("A roll back of '%s' was interrupted; it can only be rolled back" % bag.path)
+        self._open()
+        # manifests are only recorded as rewritten once their transaction has committed, so roll back any other
+        recover_overwrites(bag.path)
+        # only the renames of batches not marked done need checking
+        for old, new in state.pending:
+            _recover_rename(bag.path, old, new)
+        if not state.renamed:
+            self._write(['renamed'], sync=True)
+        bag.update_payload_filenames(rename_map=state.rename_map, processes=processes,
+                                     rewritten_manifests=state.rewritten_manifests,
+                                     on_manifest_rewritten=self.record_manifest)
+        self.finish()
+        return state
+
+    def roll_back(self, bag, processes=1):
+        """undo the interrupted update of the bag (a bag_updater.Bag)"""
+        state = self._load_for(bag)
+        self._open()
+        if not state.rolling_back:
+            self._write(['rollback'], sync=True)
+        recover_overwrites(bag.path)
+        if state.renamed or state.rewritten_manifests:
+            # rewriting is idempotent, so manifests that weren't rewritten are simply left as they are
+            inverse_map = collections.OrderedDict((new, old) for old, new in state.rename_map.items())
+            bag.update_payload_filenames(rename_map=inverse_map, processes=processes)
+        for old, new in reversed(list(state.rename_map.items())):
+            _recover_rename(bag.path, new, old)
+        self.finish()
+        return state
+
+    def _load_for(self, bag):
+        state = self.load()
+        if state.bag != bag.path:
+            raise RenameJournalError("Journal '%s' is of bag '%s', not '%s'" % (self.path, state.bag, bag.path))
+        return state
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+            # drop a torn last record, so that the records appended from here on aren't joined to it
+            self._file.seek(0, os.SEEK_END)
+            size = self._file.tell()
+            if size > 0:
+                with open(self.path, 'rb') as f:
+                    f.seek(max(0, size - 64 * 1024))
+                    tail = f.read()
+                if not tail.endswith(b'\n'):
+                    self._file.truncate(size - len(tail) + tail.rfind(b'\n') + 1)
+
+    def _write(self, record, sync=False):
+        self._write_all([record], sync=sync)
+
+    def _write_all(self, records, sync=False):
+        self._file.write(b''.join(json.dumps(record).encode('utf-8') + b'\n' for record in records))
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _recover_rename(basedir, old, new):
+    """make sure old has been renamed to new, where the rename may or may not already have been made, or may
+    have failed
+    """
+    old_path = os.path.join(basedir, old)
+    new_path = os.path.join(basedir, new)
+    old_exists = os.path.lexists(old_path)
+    new_exists = os.path.lexists(new_path)
+    if old_exists and not new_exists:
+        os.rename(old_path, new_path)
+    elif old_exists and old_path.lower() == new_path.lower() and os.path.samefile(old_path, new_path):
+        # names differing only in case, on a case-insensitive filesystem: renamed once the listing has the new one
+        if os.path.basename(new_path) not in os.listdir(os.path.dirname(new_path)):
+            os.rename(old_path, new_path)
+    elif old_exists:
+        raise RenameJournalError("Cannot recover rename of '%s' to '%s': both exist; move '%s' out of the bag, "
+                                 "and recover again" % (old, new, new_path))
+    elif not new_exists:
+        # e.g. the rename failed because the file had been removed: there's nothing to rename, and the bag's
+        # completeness check after the recovery reports it missing
+        LOGGER.warning("Cannot recover rename of '%s' to '%s': neither exists", old, new)
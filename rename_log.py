@@ -0,0 +1,331 @@
+"""Streaming logs of renames (and other rows of paths): rename maps, rename logs and confirmation reports.
+
+A log is a sequence of rows of strings, the first being the column names, written as they're produced
+through a large buffer, in one of the formats:
+
+    csv     as the scripts have always written
+    ndjson  a JSON array per line
+    binary  MAGIC, the number of columns (a little-endian uint32) and their names; then each row's cells,
+            UTF-8 and each ended by a NUL (rows being padded to the number of columns); then the uint64 offsets
+            of the rows, and a footer of the index's offset, the number of rows and MAGIC. A reader memory-maps
+            the log, and can find any row without parsing those before it, or decode and split a run of rows
+            with a single call each
+
+and optionally compressed with gzip, or zstd where the zstandard package is installed (a compressed binary
+log is decompressed into memory to be read, rather than mapped). Readers detect the format and compression
+from the file's contents. Cells are read back as native strings: bytes under Python 2, as its csv module gives.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import csv
+import gzip
+import io
+import json
+import mmap
+import struct
+import sys
+import tempfile
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG_FORMATS = ('csv', 'ndjson', 'binary')
+LOG_COMPRESSIONS = ('none', 'gzip', 'zstd')
+FORMAT_EXTENSIONS = {'csv': '.csv', 'ndjson': '.ndjson', 'binary': '.rnlog'}
+COMPRESSION_EXTENSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+# rows of a binary log decoded at a time
+CELL_RUN_ROWS = 65536
+
+MAGIC = b'RNLOG\x00\x01\n'
+_COLUMNS = struct.Struct('<I')
+_OFFSET = struct.Struct('<Q')
+_FOOTER = struct.Struct('<QQ%ds' % len(MAGIC))
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+PY2 = sys.version_info[0] == 2
+# paths that aren't valid UTF-8 are kept as they are, as os functions do under Python 3
+_ERRORS = 'strict' if PY2 else 'surrogateescape'
+
+
+class RenameLogError(Exception):
+    pass
+
+
+def log_filename(prefix, format='csv', compression='none'):
+    """prefix with the extension of a log in the format and compression"""
+    return prefix + FORMAT_EXTENSIONS[format] + COMPRESSION_EXTENSIONS[compression or 'none']
+
+
+def check_compression(compression):
+    """raise a RenameLogError if logs can't be written with the compression"""
+    if compression not in LOG_COMPRESSIONS:
+        raise RenameLogError("Unknown log compression '%s'" % compression)
+    if compression == 'zstd' and zstandard is None:
+        raise RenameLogError('zstd compression needs the zstandard package')
+
+
+class RenameLogWriter(object):
+    """Writes a log to path as its rows are produced, starting with the columns' names."""
+
+    def __init__(self, path, columns, format='csv', compression='none', buffer_size=DEFAULT_BUFFER_SIZE):
+        if format not in LOG_FORMATS:
+            raise RenameLogError("Unknown log format '%s'" % format)
+        compression = compression or 'none'
+        check_compression(compression)
+        self.path = path
+        self.format = format
+        self.compression = compression
+        self.rows = 0
+        self._file = io.open(path, 'wb', buffering=buffer_size)
+        self._compressor = None
+        if compression == 'gzip':
+            self._compressor = self._stream = gzip.GzipFile(fileobj=self._file, mode='wb')
+        elif compression == 'zstd':
+            self._compressor = self._stream = zstandard.ZstdCompressor().stream_writer(self._file, closefd=False)
+        else:
+            self._stream = self._file
+        self._text = None
+        self._index = None
+        if format == 'binary':
+            # the rows' offsets are spilled to a temporary file, so that memory use doesn't grow with the log
+            self._index = tempfile.TemporaryFile()
+            self._columns = len(columns)
+            self._stream.write(MAGIC + _COLUMNS.pack(len(columns)))
+            self._offset = len(MAGIC) + _COLUMNS.size
+            self._write_cells(columns)
+        else:
+            if PY2:
+                # Python 2's csv module writes bytes, as do we
+                self._text = self._stream
+            else:
+                self._text = io.TextIOWrapper(self._stream, encoding='utf-8', errors=_ERRORS, newline='')
+            self._csv = csv.writer(self._text) if format == 'csv' else None
+            self.writerow(columns)
+            self.rows = 0
+
+    def writerow(self, row):
+        if self._index is not None:
+            if len(row) != self._columns:
+                if len(row) > self._columns:
+                    raise RenameLogError('A row of a binary log can have at most %d cells: %r' % (self._columns, row))
+                row = list(row) + [''] * (self._columns - len(row))
+            self._index.write(_OFFSET.pack(self._offset))
+            self._write_cells(row)
+        elif self._csv is not None:
+            self._csv.writerow([_native(cell) for cell in row])
+        else:
+            self._text.write(json.dumps([_text(cell) for cell in row]))
+            self._text.write(b'\n' if PY2 else '\n')
+        self.rows += 1
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def logging(self, rows):
+        """yield each of rows, writing it to the log"""
+        for row in rows:
+            self.writerow(row)
+            yield row
+
+    def close(self):
+        if self._file is None:
+            return
+        try:
+            if self._index is not None:
+                index_offset = self._offset
+                self._index.seek(0)
+                for block in iter(lambda: self._index.read(DEFAULT_BUFFER_SIZE), b''):
+                    self._stream.write(block)
+                self._index.close()
+                self._stream.write(_FOOTER.pack(index_offset, self.rows, MAGIC))
+            elif not PY2:
+                self._text.flush()
+                self._text.detach()
+            if self._compressor is not None:
+                self._compressor.close()
+        finally:
+            self._file.close()
+            self._file = None
+
+    def _write_cells(self, cells):
+        try:
+            # encoded together, as the cells are usually all text
+            record = ('\0'.join(cells) + '\0').encode('utf-8', _ERRORS)
+        except (TypeError, UnicodeDecodeError):
+            record = b'\0'.join(_bytes(cell) for cell in cells) + b'\0'
+        if record.count(b'\0') != len(cells):
+            raise RenameLogError('The cells of a binary log may not contain NULs: %r' % (cells,))
+        self._stream.write(record)
+        self._offset += len(record)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RenameLogReader(object):
+    """Reads a log written by RenameLogWriter (or a CSV one written before it), of any format and compression.
+
+    columns is the first row, the columns' names, and iterating gives the rest. A binary log can also be
+    indexed, and its len() taken, without reading its rows.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = io.open(path, 'rb')
+        self._map = self._buffer = None
+        magic = self._file.read(len(MAGIC))
+        if magic.startswith(_GZIP_MAGIC):
+            self.compression = 'gzip'
+        elif magic.startswith(_ZSTD_MAGIC):
+            if zstandard is None:
+                raise RenameLogError("Reading the zstd-compressed log '%s' needs the zstandard package" % path)
+            self.compression = 'zstd'
+        else:
+            self.compression = 'none'
+        if self.compression != 'none':
+            # the format is told by the start of the decompressed log, then read from the start again
+            magic = self._decompressed().read(len(MAGIC))
+        self._stream = self._decompressed()
+        if magic == MAGIC:
+            self.format = 'binary'
+            if self.compression == 'none':
+                self._buffer = self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._buffer = self._stream.read()
+            self._open_binary()
+        else:
+            self.format = 'ndjson' if magic[:1] == b'[' else 'csv'
+            if PY2:
+                self._text = self._stream
+            else:
+                self._text = io.TextIOWrapper(self._stream, encoding='utf-8', errors=_ERRORS, newline='')
+            self._rows = self._text_rows()
+            self.columns = next(self._rows, [])
+
+    def _decompressed(self):
+        """a stream of the log's contents from its start"""
+        self._file.seek(0)
+        if self.compression == 'gzip':
+            return gzip.GzipFile(fileobj=self._file, mode='rb')
+        if self.compression == 'zstd':
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(self._file, closefd=False))
+        return self._file
+
+    def _open_binary(self):
+        buffer = self._buffer
+        if len(buffer) < len(MAGIC) + _COLUMNS.size + _FOOTER.size:
+            raise RenameLogError("Log '%s' is incomplete" % self.path)
+        self._index_offset, self._count, magic = _FOOTER.unpack_from(buffer, len(buffer) - _FOOTER.size)
+        if magic != MAGIC:
+            raise RenameLogError("Log '%s' is incomplete: it has no index" % self.path)
+        self._columns, = _COLUMNS.unpack_from(buffer, len(MAGIC))
+        # the names end at the first row, or if there are none at the index
+        start = len(MAGIC) + _COLUMNS.size
+        end = self._offset(0) if self._count else self._index_offset
+        self.columns = _split_cells(buffer[start:end])
+
+    def _text_rows(self):
+        if self.format == 'csv':
+            for row in csv.reader(self._text):
+                yield row
+        else:
+            for line in self._text:
+                if line.strip():
+                    yield [_native(cell) for cell in json.loads(line)]
+
+    def _offset(self, i):
+        """the offset of row i, or for i the number of rows, of the end of the rows"""
+        if i >= self._count:
+            return self._index_offset
+        return _OFFSET.unpack_from(self._buffer, self._index_offset + _OFFSET.size * i)[0]
+
+    def _cell_runs(self):
+        """the cells of a binary log's rows, a run of up to CELL_RUN_ROWS rows' at a time"""
+        for i in range(0, self._count, CELL_RUN_ROWS):
+            yield _split_cells(self._buffer[self._offset(i):self._offset(i + CELL_RUN_ROWS)])
+
+    def __len__(self):
+        if self.format != 'binary':
+            raise TypeError("a %s log's rows can't be counted without reading it" % self.format)
+        return self._count
+
+    def __getitem__(self, i):
+        if self.format != 'binary':
+            raise TypeError("a %s log's rows can only be read in order" % self.format)
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return _split_cells(self._buffer[self._offset(i):self._offset(i + 1)])
+
+    def __iter__(self):
+        if self.format == 'binary':
+            return self._binary_rows()
+        return self._rows
+
+    def _binary_rows(self):
+        columns = self._columns
+        for cells in self._cell_runs():
+            for i in range(0, len(cells), columns):
+                yield cells[i:i + columns]
+
+    def column(self, name):
+        """yield the cell in the named column of each row (that has one)"""
+        try:
+            column = self.columns.index(_native(name))
+        except ValueError:
+            raise RenameLogError("Log '%s' has no column '%s'" % (self.path, name))
+        if self.format == 'binary':
+            # a whole run's column at a time, without making its rows
+            for cells in self._cell_runs():
+                for cell in cells[column::self._columns]:
+                    yield cell
+            return
+        for row in self:
+            if len(row) > column:
+                yield row[column]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._buffer = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _split_cells(data):
+    """the NUL-ended cells in data"""
+    if PY2:
+        return data.split(b'\0')[:-1]
+    return data.decode('utf-8', _ERRORS).split('\0')[:-1]
+
+
+def _bytes(cell):
+    return cell if isinstance(cell, bytes) else cell.encode('utf-8', _ERRORS)
+
+
+def _native(cell):
+    """cell as a native string: UTF-8 bytes under Python 2"""
+    if PY2:
+        return _bytes(cell)
+    return cell
+
+
+def _text(cell):
+    """cell as text, for JSON"""
+    return cell.decode('utf-8') if isinstance(cell, bytes) else cell
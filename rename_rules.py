@@ -0,0 +1,274 @@
+"""Rules for the new names of a bag's payload files.
+
+A rule set is declared in a JSON file, e.g. the default (JHU) rules:
+
+    {
+        "variables": {"institution": "jhu"},
+        "collection_pattern": "^[^-]*(?:-[^-]*)?",
+        "rules": [
+            {"match": "^{institution}_", "skip": true},
+            {"template": "{institution}_{collection}_{parent}-{name}"}
+        ]
+    }
+
+For each file, the first rule that matches it applies: a skip rule leaves the file as it's named; otherwise
+the file's new name (in the same directory) is the rule's template, a str.format() string. A rule without a
+"match" (a regex searched for in the file name) or "match_path" (a regex searched for in its path relative to
+the bag, with / separators) matches every file. A file that no rule matches is left as it's named. The fields
+of the templates, and of the regexes (where regex braces must be doubled), are:
+
+    the "variables"
+    collection  the match of "collection_pattern" at the start of the bag's directory name (by default its first
+                two - separated fields), or the whole name without one
+    bag         the bag's directory name
+    path        the file's path relative to the bag, with / separators
+    name        the file's name; stem and ext are the name split before its last . (ext including the .)
+    parent      the name of the file's directory
+    dirs        the names of the directories in the file's path, e.g. {dirs[1]}
+    the named groups of the rule's regexes
+
+The rules are compiled once for each bag (for_bag()), the fields that are the same for all of its files
+filled in, and are then applied to paths in bulk, without any filesystem access.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import io
+import json
+import os
+import re
+import string
+
+DEFAULT_RULES = {
+    'variables': {'institution': 'jhu'},
+    'collection_pattern': '^[^-]*(?:-[^-]*)?',
+    'rules': [
+        {'match': '^{institution}_', 'skip': True},
+        {'template': '{institution}_{collection}_{parent}-{name}'},
+    ],
+}
+
+RULE_KEYS = frozenset(['match', 'match_path', 'skip', 'template'])
+# the fields with a value for each file, computed only if a rule uses them
+FILE_FIELDS = frozenset(['path', 'name', 'stem', 'ext', 'parent', 'dirs'])
+# stands for the file name in a template formatted for a whole directory (it can't be in a file name)
+NAME_MARKER = '\0'
+
+
+class RenameRuleError(ValueError):
+    pass
+
+
+class RenameRules(object):
+    """A rule set, as declared in a config (a dict, as in DEFAULT_RULES)."""
+
+    def __init__(self, config=None):
+        if config is None:
+            config = DEFAULT_RULES
+        unknown = set(config) - set(['variables', 'collection_pattern', 'rules'])
+        if unknown:
+            raise RenameRuleError('Unknown rename rule settings: %s' % ', '.join(sorted(unknown)))
+        self.variables = dict(config.get('variables', {}))
+        reserved = (FILE_FIELDS | set(['collection', 'bag'])) & set(self.variables)
+        if reserved:
+            raise RenameRuleError('Rename rule variables may not be named %s' % ', '.join(sorted(reserved)))
+        self.collection_pattern = config.get('collection_pattern')
+        self.rules = list(config.get('rules', []))
+        for rule in self.rules:
+            unknown = set(rule) - RULE_KEYS
+            if unknown:
+                raise RenameRuleError('Unknown rename rule keys: %s' % ', '.join(sorted(unknown)))
+            if not rule.get('skip') and 'template' not in rule:
+                raise RenameRuleError('A rename rule must either skip or have a template: %s' % json.dumps(rule))
+
+    @classmethod
+    def from_file(cls, path):
+        with io.open(path, encoding='utf-8') as f:
+            try:
+                return cls(json.load(f))
+            except ValueError as e:
+                raise RenameRuleError("Cannot read rename rules '%s': %s" % (path, e))
+
+    def digest(self):
+        """the SHA-256 digest of the rule set, the same for equal configs"""
+        config = {'variables': self.variables, 'collection_pattern': self.collection_pattern, 'rules': self.rules}
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def for_bag(self, bag_name):
+        """the CompiledRules for the files of the bag in a directory named bag_name"""
+        collection = bag_name
+        if self.collection_pattern is not None:
+            match = re.match(self.collection_pattern, bag_name)
+            if match is not None:
+                collection = match.group(0)
+        constants = dict(self.variables, collection=collection, bag=bag_name)
+        return CompiledRules([_CompiledRule(rule, constants) for rule in self.rules])
+
+
+class _CompiledRule(object):
+    __slots__ = ('match', 'match_path', 'skip', 'template', 'fields', 'groups', 'prefix')
+
+    def __init__(self, rule, constants):
+        # regexes are formatted with the constants escaped, so that e.g. an institution is matched literally
+        escaped = dict((key, re.escape(value)) for key, value in constants.items())
+        self.match = _compile_regex(rule.get('match'), escaped)
+        self.match_path = _compile_regex(rule.get('match_path'), escaped)
+        # a match that's only a literal prefix of the name is tested with startswith
+        self.prefix = None
+        if self.match is not None:
+            literal = re.match(r'\^((?:[^\\.^$*+?{}\[\]|()]|\\[^\w])*)\Z', self.match.pattern)
+            if literal is not None:
+                self.prefix = re.sub(r'\\(.)', r'\1', literal.group(1))
+        self.skip = bool(rule.get('skip'))
+        self.template = None
+        self.fields = ()
+        self.groups = set()
+        if not self.skip:
+            for regex in (self.match, self.match_path):
+                if regex is not None:
+                    self.groups.update(regex.groupindex)
+            self.template, self.fields = _compile_template(rule['template'], constants, self.groups)
+
+    def name_template(self, directory):
+        """the (prefix, suffix) of the new names of the files in directory, if the rule depends on nothing else
+        of a file but its name, which is used once in its template; otherwise None
+        """
+        if self.match_path is not None or (self.match is not None and self.prefix is None):
+            return None
+        if self.skip:
+            return ()
+        if self.groups or not set(self.fields) <= set(['name', 'parent', 'dirs']) or \
+                self.template.count('{name}') != 1 or NAME_MARKER in self.template:
+            return None
+        fields = dict((field, _file_field(field, '', directory, NAME_MARKER)) for field in self.fields)
+        prefix, suffix = self.template.format(**fields).split(NAME_MARKER)
+        if '/' in prefix + suffix or os.sep in prefix + suffix:
+            return None
+        return prefix, suffix
+
+
+class CompiledRules(object):
+    """A rule set compiled for one bag's files.
+
+    apply() renames a batch of paths: for each of their directories, rules that depend on nothing of a file
+    but its name are reduced to a literal prefix test and a prefix and suffix of the name, so that each file
+    takes a few string operations.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def new_name(self, path):
+        """the new path of the file at path (relative to the bag), or None if it's to be left as it's named"""
+        directory, sep, name = path.rpartition(os.sep)
+        for rule in self.rules:
+            groups = {}
+            if rule.match is not None:
+                match = rule.match.search(name)
+                if match is None:
+                    continue
+                groups.update(match.groupdict())
+            if rule.match_path is not None:
+                match = rule.match_path.search(path.replace(os.sep, '/'))
+                if match is None:
+                    continue
+                groups.update(match.groupdict())
+            if rule.skip:
+                return None
+            for field in rule.fields:
+                groups[field] = _file_field(field, path, directory, name)
+            new_name = rule.template.format(**groups)
+            if not new_name or '/' in new_name or os.sep in new_name or new_name in ('.', '..'):
+                raise RenameRuleError("Rename rule gives '%s' an invalid name: '%s'" % (path, new_name))
+            return directory + sep + new_name
+        return None
+
+    def apply(self, paths):
+        """(path, new path or None) for each of paths"""
+        planned = []
+        append = planned.append
+        # the name rules of each directory (None where the general rules must be applied)
+        directories = {}
+        for path in paths:
+            directory, sep, name = path.rpartition(os.sep)
+            try:
+                name_rules = directories[directory]
+            except KeyError:
+                name_rules = directories[directory] = self._name_rules(directory)
+            if name_rules is None:
+                append((path, self.new_name(path)))
+                continue
+            new_path = None
+            for prefix, new_prefix, new_suffix in name_rules:
+                if prefix is None or name.startswith(prefix):
+                    if new_prefix is not None:
+                        new_path = directory + sep + new_prefix + name + new_suffix
+                    break
+            append((path, new_path))
+        return planned
+
+    def _name_rules(self, directory):
+        """(literal prefix or None, new name prefix, suffix) of each rule for the files in directory (the new name
+        prefix and suffix being None for a skip rule), if they're all name rules; otherwise None
+        """
+        name_rules = []
+        for rule in self.rules:
+            template = rule.name_template(directory)
+            if template is None:
+                return None
+            name_rules.append((rule.prefix,) + (template or (None, None)))
+        return name_rules
+
+
+def _compile_regex(pattern, escaped_constants):
+    if pattern is None:
+        return None
+    try:
+        return re.compile(pattern.format(**escaped_constants))
+    except (KeyError, IndexError, ValueError, re.error) as e:
+        raise RenameRuleError("Invalid rename rule regex '%s': %s" % (pattern, e))
+
+
+def _compile_template(template, constants, groups):
+    """the template with the constants filled in, and the file fields it needs"""
+    parts = []
+    fields = set()
+    try:
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+            parts.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field_name is None:
+                continue
+            key = re.match(r'\w*', field_name).group(0)
+            if key in constants and not format_spec and not conversion and key == field_name:
+                parts.append(constants[key].replace('{', '{{').replace('}', '}}'))
+                continue
+            if key in constants:
+                raise RenameRuleError("Rename rule template field '%s' can't be formatted" % field_name)
+            if key not in FILE_FIELDS and key not in groups:
+                raise RenameRuleError("Unknown rename rule template field '%s'" % field_name)
+            if key in FILE_FIELDS:
+                fields.add(key)
+            parts.append('{%s%s%s}' % (field_name, '!' + conversion if conversion else '',
+                                       ':' + format_spec if format_spec else ''))
+    except ValueError as e:
+        raise RenameRuleError("Invalid rename rule template '%s': %s" % (template, e))
+    return ''.join(parts), tuple(sorted(fields))
+
+
+def _file_field(field, path, directory, name):
+    if field == 'name':
+        return name
+    if field == 'parent':
+        return directory.rpartition(os.sep)[2]
+    if field == 'path':
+        return path.replace(os.sep, '/')
+    if field == 'dirs':
+        return directory.split(os.sep) if directory else []
+    stem, dot, ext = name.rpartition('.')
+    if not stem:
+        # no extension (or a dot file)
+        stem, ext = name, ''
+    else:
+        ext = dot + ext
+    return stem if field == 'stem' else ext
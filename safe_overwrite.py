@@ -1,5 +1,9 @@
+import binascii
 import contextlib
+import errno
+import json
 import os
+import shutil
 import stat
 import sys
 import tempfile
@@ -7,16 +11,27 @@ import tempfile
 @contextlib.contextmanager
 def safe_overwrite(filepath, deleteOnFailure=True, prefix='', suffix='.tmp', text=True):
     dir = os.path.dirname(filepath)
-    filestatus = os.stat(filepath)
-    uid = filestatus.st_uid
-    gid = filestatus.st_gid
-    mode = stat.S_IMODE(filestatus.st_mode)
+    try:
+        filestatus = os.stat(filepath)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        # a new file: created as open() would, rather than with mkstemp's private mode
+        filestatus = None
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    else:
+        uid = filestatus.st_uid
+        gid = filestatus.st_gid
+        mode = stat.S_IMODE(filestatus.st_mode)
 
     tmp_fd, tmp_filepath = tempfile.mkstemp(dir=dir, prefix=prefix, suffix=suffix, text=text)
 
     try:
         with os.fdopen(tmp_fd, 'w' if text else 'wb') as f:
-            os.chown(tmp_filepath, uid, gid)
+            if filestatus is not None:
+                os.chown(tmp_filepath, uid, gid)
             os.chmod(tmp_filepath, mode)
             yield f
         os.rename(tmp_filepath, filepath)
@@ -24,3 +39,151 @@ def safe_overwrite(filepath, deleteOnFailure=True, prefix='', suffix='.tmp', tex
     finally:
         if deleteOnFailure and (tmp_filepath is not None):
                 os.unlink(tmp_filepath)
+
+
+# transactions' files are named with this prefix, in the directory of the files they overwrite
+TRANSACTION_PREFIX = '.overwrite-'
+
+
+class OverwriteTransaction(object):
+    """Overwrites several files in one directory (e.g. a bag's manifests) together, durably.
+
+    staged_path() gives a temporary file, with the target's mode and owner, to write a file's new version
+    to (in this process or another). commit() then fsyncs the staged files, durably records the commit in a
+    marker file, renames them all over their targets and fsyncs the directory: two directory fsyncs whatever
+    the number of files. Until the marker is removed, each target's old version is kept as a hard link (or
+    copy), so that recover_overwrites() can roll back a commit that was interrupted part way, and never leaves a mix of
+    old and new versions. A transaction that isn't committed is aborted on exit, removing its files.
+    """
+
+    def __init__(self, dir):
+        self.dir = os.path.abspath(dir)
+        self.name = '%s%d-%s' % (TRANSACTION_PREFIX, os.getpid(), binascii.hexlify(os.urandom(4)).decode('ascii'))
+        self.marker = os.path.join(self.dir, self.name + '.commit')
+        # (staged, backup or None if the target doesn't exist, target) for each file
+        self.files = []
+        self.committing = self.committed = False
+
+    def staged_path(self, filepath):
+        """the path of a new, empty file to which to write the new version of filepath"""
+        filepath = os.path.join(self.dir, os.path.basename(filepath))
+        prefix = '%s.%s.' % (self.name, os.path.basename(filepath))
+        staged = os.path.join(self.dir, prefix + 'new')
+        os.close(os.open(staged, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+        backup = None
+        if os.path.exists(filepath):
+            _copy_mode(filepath, staged)
+            backup = os.path.join(self.dir, prefix + 'old')
+            try:
+                os.link(filepath, backup)
+            except OSError:
+                # e.g. a filesystem without hard links
+                shutil.copyfile(filepath, backup)
+                _fsync_file(backup)
+        self.files.append((staged, backup, filepath))
+        return staged
+
+    def commit(self):
+        for staged, backup, filepath in self.files:
+            _fsync_file(staged)
+        self.committing = True
+        with open(self.marker, 'w') as f:
+            json.dump([list(names) for names in self.files], f)
+            f.flush()
+            os.fsync(f.fileno())
+        # the staged files, backups and marker are all durable before any rename
+        fsync_dir(self.dir)
+        for staged, backup, filepath in self.files:
+            os.rename(staged, filepath)
+        fsync_dir(self.dir)
+        self.committed = True
+        # the commit is complete: recovery would only clean up from here
+        os.remove(self.marker)
+        for staged, backup, filepath in self.files:
+            if backup is not None:
+                os.remove(backup)
+
+    def abort(self):
+        for staged, backup, filepath in self.files:
+            for path in (staged, backup):
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+        self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.committed:
+            return
+        if self.committing:
+            # renames may have been made: put the old versions back
+            _recover_commit(self.dir, self.marker, roll_back=True)
+        self.abort()
+
+
+def recover_overwrites(dir, roll_back=True):
+    """Recover the OverwriteTransactions in dir interrupted by a crash, returning the number recovered.
+
+    A transaction whose commit was interrupted part way is rolled back to the files' old versions (or, without
+    roll_back, rolled forward to their new ones); one whose commit had completed is just cleaned up, and the files
+    of one that hadn't started committing are removed.
+    """
+    markers = [name for name in os.listdir(dir) if name.startswith(TRANSACTION_PREFIX) and name.endswith('.commit')]
+    for marker in markers:
+        _recover_commit(dir, os.path.join(dir, marker), roll_back=roll_back)
+    # whatever's left is staged files and backups no longer needed
+    for name in os.listdir(dir):
+        if name.startswith(TRANSACTION_PREFIX):
+            os.remove(os.path.join(dir, name))
+    return len(markers)
+
+
+def _recover_commit(dir, marker, roll_back):
+    if not os.path.exists(marker):
+        return
+    try:
+        with open(marker) as f:
+            files = json.load(f)
+    except ValueError:
+        # a torn marker, so written before any rename
+        files = []
+    # if every staged file has been renamed, the commit was complete
+    if any(os.path.exists(staged) for staged, backup, filepath in files):
+        for staged, backup, filepath in files:
+            if roll_back and not os.path.exists(staged):
+                if backup is not None:
+                    os.rename(backup, filepath)
+                elif os.path.exists(filepath):
+                    os.remove(filepath)
+            elif not roll_back and os.path.exists(staged):
+                os.rename(staged, filepath)
+        fsync_dir(dir)
+    os.remove(marker)
+
+
+def fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # e.g. Windows, where directories can't be opened
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _fsync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _copy_mode(src, dst):
+    filestatus = os.stat(src)
+    os.chown(dst, filestatus.st_uid, filestatus.st_gid)
+    os.chmod(dst, stat.S_IMODE(filestatus.st_mode))
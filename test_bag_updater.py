@@ -0,0 +1,48 @@
+from __future__ import print_function, unicode_literals
+
+import bagit
+from bag_updater import Bag, BagView
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class SymlinkedPayloadTest(unittest.TestCase):
+    """a bag with a payload file that's a symlink to another, sized and hashed by its target as bagit does"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bag_path = os.path.join(self.tmp_dir, 'bag')
+        os.makedirs(os.path.join(self.bag_path, 'x'))
+        with io.open(os.path.join(self.bag_path, 'x', 'target.bin'), 'wb') as f:
+            f.write(b'0123456789' * 2)
+        bagit.make_bag(self.bag_path, checksums=['sha256'])
+        # linked after bagging, so that the link is sized by its target's 20 bytes rather than its own 10
+        os.symlink('target.bin', os.path.join(self.bag_path, 'data', 'x', 'link.bin'))
+        bag = bagit.Bag(self.bag_path)
+        bag.save(manifests=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_bagit_validates(self):
+        self.assertEqual(bagit.Bag(self.bag_path).info['Payload-Oxum'], '40.2')
+        self.assertTrue(bagit.Bag(self.bag_path).validate())
+
+    def test_full(self):
+        self.assertTrue(Bag(self.bag_path).validate_level('full'))
+
+    def test_oxum(self):
+        self.assertTrue(Bag(self.bag_path).validate_level('oxum'))
+        self.assertTrue(BagView(self.bag_path).validate_oxum())
+
+    def test_broken_link(self):
+        os.remove(os.path.join(self.bag_path, 'data', 'x', 'target.bin'))
+        with self.assertRaises(bagit.BagValidationError):
+            Bag(self.bag_path).validate_level('oxum')
+
+
+if __name__ == '__main__':
+    unittest.main()
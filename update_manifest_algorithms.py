@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+from bag_updater import Bag
+from fixity_cache import FixityCache
+import os
+import sys
+import traceback
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add or replace the checksum algorithms of bags' manifests, "
+                                                 "reading each payload file once")
+    parser.add_argument('--payload', dest='payload_algorithms',
+                        help='comma-separated algorithms the payload manifests are to have, e.g. md5,sha512 '
+                             '(default: the current ones)')
+    parser.add_argument('--tag', dest='tag_algorithms',
+                        help='comma-separated algorithms the tag manifests are to have (default: the current ones)')
+    parser.add_argument('--processes', dest='processes', type=int, default=1,
+                        help='Use multiple processes to calculate checksums faster (default: %(default)s)')
+    parser.add_argument('--fixity-cache', dest='fixity_cache',
+                        help='SQLite file of cached payload checksums, as for rename_bag_payload')
+    parser.add_argument('directories', nargs='+', help='one or more BagIt directories')
+    args = parser.parse_args()
+
+    payload_algorithms = args.payload_algorithms.split(',') if args.payload_algorithms else None
+    tag_algorithms = args.tag_algorithms.split(',') if args.tag_algorithms else None
+    fixity_cache = FixityCache(args.fixity_cache) if args.fixity_cache is not None else None
+    failures = 0
+    try:
+        for bag_dir in args.directories:
+            bag_name = os.path.basename(os.path.abspath(bag_dir))
+            print("Updating manifest algorithms of bag '%s'..." % bag_name, end='')
+            try:
+                bag = Bag(bag_dir, fixity_cache=fixity_cache)
+                bag.update_manifest_algorithms(payload_algorithms=payload_algorithms, tag_algorithms=tag_algorithms,
+                                               processes=args.processes)
+            except Exception:
+                print('')
+                traceback.print_exc()
+                print("... Failed updating bag '%s'" % bag_name)
+                failures += 1
+            else:
+                print('finished.')
+    finally:
+        if fixity_cache is not None:
+            fixity_cache.close()
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
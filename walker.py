@@ -1,25 +1,117 @@
 from __future__ import print_function, unicode_literals
 
 import collections
+from fs_executor import FsExecutor
 import os
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5
+    from scandir import scandir
 
 
-WalkerItem = collections.namedtuple('WalkerItem', ['depth', 'type', 'path'])
+WalkerItem = collections.namedtuple('WalkerItem', ['depth', 'type', 'path', 'size', 'inode', 'mtime'])
+# size, inode and mtime (in ns) are only filled in when walk_dir() is asked to stat
+WalkerItem.__new__.__defaults__ = (None, None, None)
 
 
-def walk_dir(dir, onerror=None, followlinks=False, max_depth=None, _depth=0):
-    root, subdirs, files = next(os.walk(dir, onerror=onerror, followlinks=followlinks))
+def walk_dir(dir, onerror=None, followlinks=False, max_depth=None, sort=False, stat=False, absolute=True,
+             executor=None):
+    """Yield a WalkerItem for dir, and for each file and directory below it.
 
-    yield WalkerItem(path=os.path.abspath(root), depth=_depth, type='dir')
+    Each directory is immediately followed by its files and then, depth first, by its subdirectories.
+    Directories are listed with scandir from an explicit stack, so the depth of the tree isn't limited
+    by the recursion limit. Symlinks to directories are yielded, but only walked into with followlinks.
+    With sort, the entries of each directory are in name order. With stat, the size, inode and mtime are
+    taken from the directory entries' stat, so callers needn't stat the paths again; as with os.stat, those of
+    a symlinked file are its target's. Paths are absolute
+    unless absolute is False, in which case they're joined to dir as given, like os.walk's.
 
-    _depth += 1
-    if max_depth is not None and _depth > max_depth:
-        return
+    With an executor (fs_executor.FsExecutor), the directories next on the stack are listed (and their
+    entries stat'd) ahead, up to the executor's depth at a time; what's yielded, and in what order, is the same.
+    """
+    if absolute:
+        dir = os.path.abspath(dir)
+    root_stat = None
+    if stat:
+        try:
+            root_stat = os.stat(dir)
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            return
 
-    for file in files:
-        yield WalkerItem(path=os.path.abspath(os.path.join(root, file)), depth=_depth, type='file')
-    for subdir in subdirs:
-        # loop as alternative to "yield from ..." for Python versions pre-3.3
-        for item in walk_dir(os.path.join(root, subdir), onerror=onerror, followlinks=followlinks,
-                             max_depth=max_depth, _depth=_depth):
+    if executor is None:
+        executor = FsExecutor(1)
+    # each directory still to list: (depth, path, stat)
+    stack = [(0, dir, root_stat)]
+    # the listings started ahead by the executor, by path
+    listings = {}
+    while stack:
+        depth, path, dir_stat = stack.pop()
+        if path in listings:
+            listing = listings.pop(path)()
+        else:
+            listing = executor.submit(_list_dir, path, sort, stat, followlinks)()
+        if listing.error is not None:
+            if onerror is not None:
+                onerror(listing.error)
+            continue
+        yield _item(depth, 'dir', path, dir_stat)
+
+        depth += 1
+        if max_depth is not None and depth > max_depth:
+            continue
+
+        subdirs = []
+        linked_dirs = []
+        for entry_path, is_dir, is_symlink, entry_stat, stat_error in listing.value:
+            if stat_error is not None and onerror is not None:
+                onerror(stat_error)
+            if not is_dir:
+                yield _item(depth, 'file', entry_path, entry_stat)
+            elif followlinks or not is_symlink:
+                subdirs.append((depth, entry_path, entry_stat))
+            else:
+                linked_dirs.append(_item(depth, 'dir', entry_path, entry_stat))
+        for item in linked_dirs:
             yield item
+        stack.extend(reversed(subdirs))
+
+        if executor.depth > 1:
+            for _, next_path, _ in stack[:-executor.depth - 1:-1]:
+                if next_path not in listings:
+                    listings[next_path] = executor.submit(_list_dir, next_path, sort, stat, followlinks)
+
+
+def _list_dir(path, sort, stat, followlinks):
+    """(path, is_dir, is_symlink, stat or None, stat's OSError or None) for each entry of a directory"""
+    entries = list(scandir(path))
+    if sort:
+        entries.sort(key=lambda entry: entry.name)
+    listing = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        entry_stat = None
+        stat_error = None
+        if stat:
+            try:
+                # a symlinked file is payload like any other, so is sized by its target, as bagit does
+                entry_stat = entry.stat(follow_symlinks=followlinks or not is_dir)
+            except OSError as e:
+                stat_error = e
+        is_symlink = is_dir and not followlinks and entry.is_symlink()
+        listing.append((entry.path, is_dir, is_symlink, entry_stat, stat_error))
+    return listing
+
+
+def _item(depth, type, path, st):
+    if st is None:
+        return WalkerItem(depth=depth, type=type, path=path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1000000000))
+    return WalkerItem(depth=depth, type=type, path=path, size=st.st_size, inode=st.st_ino, mtime=mtime_ns)